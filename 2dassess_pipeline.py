@@ -3,157 +3,198 @@
 Use the 2DAssess to assess class averages.
 Will predict each image files in the input directory and save to the folders
 with corresponding labels in the input directory path.
-Input should be the mrcs file of the 2D class averages.
+Input should be the mrcs file of the 2D class averages, or the 2DClass directory
+with one subdirectory per diameter sweep (with --mrcs_name). Then all the sweeps
+are assessed in one batch with a single model load, and the good particle
+fraction of every sweep is written to the output file.
 Will also save a goodlist file (pickle file) for future use.
+The class averages are trimmed, normalized and resized in memory as one batch,
+which is fed to both the classifier and the centering check. The jpg files of
+the classes sorted by label are only written with --save_jpg.
+If the model server (model_server.py) is running, the predictions are sent to it
+instead of loading the model in this process.
 '''
 
-from keras.models import *
-from keras.preprocessing.image import ImageDataGenerator
-from keras import metrics
-from keras.optimizers import *
-from keras import backend as keras
 import numpy as np
 import pandas as pd
 import os
 import argparse
-from shutil import copy2
 import shutil
-import glob
 import pickle
-from functools import partial, update_wrapper
-from itertools import product
-from classavg_preprocessing_p import preprocess
-from check_center_p import check_center
-from classavg2jpg_pipeline import save_mrcs
-import re
+from PIL import Image
+from batch_preprocess import preprocess_batch
+from check_center_p import check_centers
+from classavg2jpg_pipeline import classavg_images, classavg_batch
+from mrc_io import read_mrc
+from star_io import read_star_block, read_star, write_star_blocks
+from assess_models import get_predictor, batch_size_arg
 
 def setupParserOptions():
     ap = argparse.ArgumentParser()
     ap.add_argument('-i', '--input',
-                    help="Input mrcs file of 2D class averages.")
+                    help="Input mrcs file of 2D class averages, or the 2DClass directory of all the diameter sweeps.")
+    ap.add_argument('--mrcs_name',
+                    help="Only used when the input is a directory. Name of the mrcs file in every sweep subdirectory (e.g. run_it025_classes.mrcs).")
     ap.add_argument('-o', '--output', default='2DAssess',
-                    help="Name of the output directory. Default is 2DAssess.")
+                    help="Name of the output directory (parent directory of one directory per sweep if the input is a directory). Default is 2DAssess.")
     ap.add_argument('-m', '--model', default='./models/2dassess_062119.h5',
                     help='Path to the model.h5 file.')
     ap.add_argument('-n', '--name',
-                    help="Name (prefix) of the particle.")
+                    help="Name (prefix) of the particle. The name of the sweep subdirectory is used if the input is a directory.")
     ap.add_argument('--starfile',
-                    help="Corresponding _model.star file for the input mrc file.")
+                    help="Corresponding _model.star file for the input mrc file. Only the file name (e.g. run_it025_model.star) if the input is a directory.")
     ap.add_argument('--outfile', default='good_part_frac.txt',
                     help="Name of the output file to store the fraction of the good particles. Default is good_part_frac.txt.")
+    ap.add_argument('-b', '--batch_size', type=batch_size_arg, default=32,
+                    help="Batch size used in prediction, or auto to choose it from the free memory. Default is 32. The batch size is halved automatically if the prediction runs out of memory.")
+    ap.add_argument('--socket', default=None,
+                    help="Unix socket of the model server. Default is $CRYOASSESS_SOCKET or /tmp/cryoassess_<uid>.sock. The model is loaded locally if no server is running.")
+    ap.add_argument('--backend', default='keras', choices=['keras', 'onnx'],
+                    help="keras: run the .h5 model with Keras (default). onnx: run an ONNX export of the model on the CPU (see cpu_backend.py), -m is then the .onnx file.")
+    ap.add_argument('--intra_op_threads', '--threads', type=int, default=0,
+                    help="Only used with --backend onnx. Threads used inside an operator. Default is 0 (all cores).")
+    ap.add_argument('--inter_op_threads', type=int, default=0,
+                    help="Only used with --backend onnx. Threads used to run independent operators in parallel. Default is 0.")
+    ap.add_argument('--save_jpg', action='store_true',
+                    help="Also save the class averages as jpg files in one directory per label (Clip, Edge, Good, Noise) in the output directory.")
     args = vars(ap.parse_args())
     return args
 
-def wrapped_partial(func, *args, **kwargs):
-    partial_func = partial(func, *args, **kwargs)
-    update_wrapper(partial_func, func)
-    return partial_func
-
-def w_categorical_crossentropy(y_true, y_pred, weights):
-    nb_cl = len(weights)
-    final_mask = K.zeros_like(y_pred[:, 0])
-    y_pred_max = K.max(y_pred, axis=1)
-    y_pred_max = K.reshape(y_pred_max, (K.shape(y_pred)[0], 1))
-    y_pred_max_mat = K.cast(K.equal(y_pred, y_pred_max), K.floatx())
-    for c_p, c_t in product(range(nb_cl), range(nb_cl)):
-        final_mask += (weights[c_t, c_p] * y_pred_max_mat[:, c_p] * y_true[:, c_t])
-    return K.categorical_crossentropy(y_true, y_pred) * final_mask
-
 def class2d_star2df(starfile):
-    with open(starfile) as f:
-        star = f.readlines()[29:239]
-    for i in range(len(star)):
-        if 'loop_' in star[i]:
-            start_idx = i
-            break
-    key_idx = []
-    for j in range(start_idx+1, len(star)):
-        if star[j].startswith('_'):
-            key_idx.append(j)
-    keys = [star[ii] for ii in key_idx]
-    star_df = star[1+key_idx[-1]:]
-    star_df = [x.split() for x in star_df]
-    star_df = pd.DataFrame(star_df)
-    star_df = star_df.dropna()
-    star_df.columns = keys
+    '''
+    Class table (rlnReferenceImage, rlnClassDistribution) of a _model.star file.
+    '''
+    return read_star_block(starfile, 'data_model_classes',
+                           columns=['rlnReferenceImage', 'rlnClassDistribution'])
 
-    return star_df
+def predict_batch(predictor, stack):
+    '''
+    Predict an (N, 256, 256) uint8 stack of class averages batch by batch,
+    normalized per sample like the Keras generator did (no mask).
+    '''
+    prob = []
+    i = 0
+    while i < len(stack):
+        batch_size = predictor.batch_size
+        batch = preprocess_batch(stack[i:i+batch_size].astype('float32'), mask=False)
+        i += batch_size
+        prob.append(predictor(batch[..., np.newaxis]))
+    return np.concatenate(prob) if prob else np.empty((0, 4))
 
-def predict(**args):
+def list_sweeps(**args):
+    '''
+    (name, mrcs file, _model.star file, output directory) of every sweep to assess.
+    '''
+    if not os.path.isdir(args['input']):
+        return [(args['name'], args['input'], args['starfile'], args['output'])]
+    sweeps = []
+    for name in sorted(os.listdir(args['input'])):
+        mrcs_file = os.path.join(args['input'], name, args['mrcs_name'])
+        if os.path.isfile(mrcs_file):
+            sweeps.append((name, mrcs_file, os.path.join(args['input'], name, args['starfile']),
+                           os.path.join(args['output'], name)))
+    return sweeps
+
+def predict(sweeps, **args):
+    '''
+    Assess the class averages of all the sweeps in one batch.
+    Returns the good class numbers (str) and the table of all the classes of
+    every sweep.
+    '''
     print('Assessing 2D class averages with 2DAssess....')
-    test_data_dir = os.path.abspath(args['output'])
     labels = ['Clip', 'Edge', 'Good', 'Noise']
-    os.chdir(test_data_dir)
-    for l in labels:
-        shutil.rmtree(l, ignore_errors=True)
-    w_array = np.ones((4, 4))
-    w_array[(0,1,3), 2] = 1.0
-    w_array[2, (0,1,3)] = 1.0
-    ncce = wrapped_partial(w_categorical_crossentropy, weights=w_array)
-
-    model = load_model(args['model'], custom_objects={'w_categorical_crossentropy': wrapped_partial(w_categorical_crossentropy, weights=w_array)})
-    model.compile(optimizer = Adam(lr = 1e-4), loss = ncce, metrics = [metrics.categorical_accuracy])
+    class_nums, images, offsets = [], [], [0]
+    for name, mrcs_file, starfile, output in sweeps:
+        nums, imgs = classavg_images(read_mrc(mrcs_file))
+        class_nums.append(nums)
+        images.extend(imgs)
+        offsets.append(len(images))
+    stack = classavg_batch(images)
+    # before the model is loaded, the worker pool must not fork Keras/TF
+    centered, centerness, object_num = check_centers(stack)
+    predictor = get_predictor('2dassess', args['model'], batch_size=args['batch_size'], socket_path=args.get('socket'),
+                              backend=args['backend'], intra_op_threads=args['intra_op_threads'],
+                              inter_op_threads=args['inter_op_threads'])
+    prob = predict_batch(predictor, stack)
+    print('Assessment finished.')
 
-    test_datagen = ImageDataGenerator(
-        rescale = 1./255,
-        samplewise_center=True,
-        samplewise_std_normalization=True)
+    pred_labels = []
+    for i in range(len(stack)):
+        label = labels[np.argmax(prob[i])]
+        if label == 'Good' and not centered[i]:
+            label = 'Clip'
+        pred_labels.append(label)
 
-    test_generator = test_datagen.flow_from_directory(
-        test_data_dir,
-        shuffle=False,
-        target_size=(256, 256),
-        batch_size=32,
-        color_mode='grayscale',
-        class_mode=None,
-        interpolation='lanczos')
-    prob = model.predict_generator(test_generator)
-    print('Assessment finished. Copying files to corresponding directories....')
+    results = []
+    for k, (name, mrcs_file, starfile, output) in enumerate(sweeps):
+        sl = slice(offsets[k], offsets[k+1])
+        classes = pd.DataFrame({'rlnClassNumber': class_nums[k],
+                                'TwoDAssessLabel': pred_labels[sl]})
+        for j, l in enumerate(labels):
+            classes['TwoDAssessProb%s' %l] = prob[sl, j]
+        classes['TwoDAssessCenterY'] = centerness[sl, 0]
+        classes['TwoDAssessCenterX'] = centerness[sl, 1]
+        classes['TwoDAssessObjectNumber'] = object_num[sl]
+        if args.get('save_jpg'):
+            test_data_dir = os.path.abspath(output)
+            for l in labels:
+                shutil.rmtree(os.path.join(test_data_dir, l), ignore_errors=True)
+                os.makedirs(os.path.join(test_data_dir, l))
+            for num, img, label in zip(class_nums[k], images[sl], pred_labels[sl]):
+                Image.fromarray(img).convert('L').save(os.path.join(test_data_dir, label, '%s_%d.jpg' %(name, num)))
+        good_idx = [str(num) for num, label in zip(class_nums[k], pred_labels[sl]) if label == 'Good']
+        results.append((good_idx, classes))
+    return results
 
-    for l in labels:
-        os.mkdir(l)
-    i = 0
-    for file in sorted(glob.glob('data/*.jpg')):
-        if labels[np.argmax(prob[i])] == 'good':
-            if check_center(file) == True:
-                copy2(file, 'Good')
-            else:
-                copy2(file, 'Clipping')
-        else:
-            copy2(file, labels[np.argmax(prob[i])])
-        i = i + 1
-
-    shutil.rmtree('data') # after prediction, remove the data directory
-    good_idx = []
-    for fname in os.listdir('Good'):
-        good_idx.append(re.findall((args['name']+'_'+'(\d+)'), fname[:-4])[0])
-    return good_idx
-
-    # print('All finished! Outputs are stored in', test_data_dir)
-    # print('Good class averages indices are (starting from 1): ', end='')
-    # print(', '.join(good_idx))
-
-def evaluate(wkdir, good_idx, **args):
+def evaluate(wkdir, good_idx, classes=None, **args):
+    '''
+    Fraction of the particles in the good classes, appended to the output file.
+    Returns it with the table of all the classes of the _model.star file, with
+    the 2DAssess results of the assessed classes (see predict) if given.
+    '''
     os.chdir(wkdir)
-    good_frac = 0
     star_df = class2d_star2df(args['starfile'])
-    for i in range(len(star_df)):
-        idx = int(re.split('@', star_df.iloc[i,0])[0])
-        if str(idx) in good_idx:
-            good_frac = good_frac + float(star_df.iloc[i,1])
+    class_num = star_df['rlnReferenceImage'].str.split('@', n=1).str[0].astype(int).values
+    dist = star_df['rlnClassDistribution'].values.astype(float)
+    good = np.isin(class_num, np.array(good_idx, dtype=int))
+    good_frac = float(dist[good].sum())
     print(good_frac)
     with open(args['outfile'], 'a+') as f:
         f.write('%s\n'%args['name'])
         f.write('%s\n'%str(good_frac))
         f.write((', '.join(good_idx) + '\n'))
-    return good_frac
+    table = pd.DataFrame({'rlnClassNumber': class_num, 'rlnClassDistribution': dist,
+                          'TwoDAssessGood': good.astype(int)})
+    if classes is not None:
+        table = table.merge(classes, on='rlnClassNumber', how='left')
+        table['TwoDAssessLabel'] = table['TwoDAssessLabel'].fillna('Empty')
+    return good_frac, table
+
+def write_results(outfile, tables):
+    '''
+    Write the class tables of the sweeps, given as {sweep name: table}, to
+    <outfile>_classes.star (one data_<sweep name> block per sweep), next to the
+    output file. Blocks of other sweeps already in the file are kept.
+    '''
+    star_name = os.path.splitext(outfile)[0] + '_classes.star'
+    blocks = read_star(star_name) if os.path.isfile(star_name) else {}
+    blocks = {k: v for k, v in blocks.items() if isinstance(v, pd.DataFrame)}
+    blocks.update(('data_%s' %name, table) for name, table in tables.items())
+    write_star_blocks(blocks, star_name, atomic=True)
 
 if __name__ == '__main__':
     # start_dir = os.getcwd()
     args = setupParserOptions()
-    wkdir = os.path.abspath(os.path.join(os.path.dirname(args['input']), os.pardir, os.pardir))
+    if os.path.isdir(args['input']):
+        wkdir = os.path.abspath(os.path.join(args['input'], os.pardir))
+        args['input'] = os.path.abspath(args['input'])
+    else:
+        wkdir = os.path.abspath(os.path.join(os.path.dirname(args['input']), os.pardir, os.pardir))
     args['model'] = os.path.abspath(args['model'])
     os.chdir(wkdir)
-    save_mrcs(wkdir, **args)
-    good_idx = predict(**args)
-    evaluate(wkdir, good_idx, **args)
+    sweeps = list_sweeps(**args)
+    results = predict(sweeps, **args)
+    tables = {}
+    for (name, mrcs_file, starfile, output), (good_idx, classes) in zip(sweeps, results):
+        good_frac, tables[name] = evaluate(wkdir, good_idx, classes, **dict(args, name=name, starfile=starfile))
+    write_results(args['outfile'], tables)
@@ -0,0 +1,200 @@
+'''
+Loading of the MicAssess and 2DAssess models, and the predictors used by the
+assessors. A predictor is a function taking a batch of preprocessed images
+(N, H, W, 1) and returning the model output.
+get_predictor uses the local model server (model_server.py) if it is running,
+and only loads the model in this process (importing Keras) otherwise.
+With backend='onnx', the model file is an ONNX export of the model
+(cpu_backend.py) and runs on the CPU with onnxruntime.
+With batch_size='auto', the batch size is chosen from the free device (GPU) or
+host memory and the memory used per sample by the model, and it is halved and
+the batch retried whenever the prediction runs out of memory.
+'''
+
+import os
+import argparse
+import subprocess
+from functools import partial, update_wrapper
+from itertools import product
+import numpy as np
+
+MODEL_KINDS = ('micassess', '2dassess')
+MODEL_INPUT_SHAPES = {'micassess': (494, 494, 1), '2dassess': (256, 256, 1)}
+DEFAULT_BATCH_SIZE = 32
+MAX_BATCH_SIZE = 256
+# without the Keras layers (onnx backend or model server), the memory per
+# sample is estimated as this many times the input size
+ACTIVATION_FACTOR = 64
+
+def batch_size_arg(s):
+    ''' argparse type of --batch_size: a positive int or auto. '''
+    if s == 'auto':
+        return s
+    try:
+        n = int(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid batch size: %r (a positive int or auto)" %s)
+    if n <= 0:
+        raise argparse.ArgumentTypeError("invalid batch size: %d (must be positive)" %n)
+    return n
+
+def wrapped_partial(func, *args, **kwargs):
+    partial_func = partial(func, *args, **kwargs)
+    update_wrapper(partial_func, func)
+    return partial_func
+
+def w_categorical_crossentropy(y_true, y_pred, weights):
+    from keras import backend as K
+    nb_cl = len(weights)
+    final_mask = K.zeros_like(y_pred[:, 0])
+    y_pred_max = K.max(y_pred, axis=1)
+    y_pred_max = K.reshape(y_pred_max, (K.shape(y_pred)[0], 1))
+    y_pred_max_mat = K.cast(K.equal(y_pred, y_pred_max), K.floatx())
+    for c_p, c_t in product(range(nb_cl), range(nb_cl)):
+        final_mask += (weights[c_t, c_p] * y_pred_max_mat[:, c_p] * y_true[:, c_t])
+    return K.categorical_crossentropy(y_true, y_pred) * final_mask
+
+def load_micassess_model(model_file):
+    from keras.models import load_model
+    from keras.optimizers import Adam
+    model = load_model(model_file)
+    model.compile(optimizer = Adam(lr = 1e-4), loss = 'binary_crossentropy', metrics = ['accuracy'])
+    return model
+
+def load_2dassess_model(model_file):
+    from keras.models import load_model
+    from keras.optimizers import Adam
+    from keras import metrics
+    w_array = np.ones((4, 4))
+    w_array[(0,1,3), 2] = 1.0
+    w_array[2, (0,1,3)] = 1.0
+    ncce = wrapped_partial(w_categorical_crossentropy, weights=w_array)
+    model = load_model(model_file, custom_objects={'w_categorical_crossentropy': ncce})
+    model.compile(optimizer = Adam(lr = 1e-4), loss = ncce, metrics = [metrics.categorical_accuracy])
+    return model
+
+def load_assess_model(kind, model_file):
+    if kind == 'micassess':
+        return load_micassess_model(model_file)
+    elif kind == '2dassess':
+        return load_2dassess_model(model_file)
+    raise ValueError('Unknown model kind %s, should be one of %s.' %(kind, ', '.join(MODEL_KINDS)))
+
+def gpu_free_memory():
+    '''
+    Free memory (bytes) of the first visible GPU, or None if there is no GPU.
+    '''
+    if os.environ.get('CUDA_VISIBLE_DEVICES') in ('', '-1'):
+        return None
+    try:
+        out = subprocess.check_output(['nvidia-smi', '--query-gpu=memory.free', '--format=csv,noheader,nounits'],
+                                      stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    free = [int(x) for x in out.decode('utf-8').split()]
+    visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+    first = int(visible.split(',')[0]) if visible else 0
+    return free[first] * 2**20 if first < len(free) else None
+
+def host_free_memory():
+    '''
+    Available host memory (bytes) from /proc/meminfo, or None if unknown.
+    '''
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def sample_bytes(kind, model=None):
+    '''
+    Memory used per sample in a prediction: the float32 outputs of all the
+    layers of the Keras model, or an estimate from the input size.
+    '''
+    if model is None:
+        return int(np.prod(MODEL_INPUT_SHAPES[kind])) * 4 * ACTIVATION_FACTOR
+    n = 0
+    for layer in model.layers:
+        shapes = layer.output_shape if isinstance(layer.output_shape, list) else [layer.output_shape]
+        n += sum(int(np.prod(shape[1:])) for shape in shapes)
+    return n * 4
+
+def auto_batch_size(kind, model=None, device='cpu', mem_fraction=0.5):
+    '''
+    Largest batch size (power of 2, at most MAX_BATCH_SIZE) whose activations
+    fit in mem_fraction of the free memory of the device ('gpu' or 'cpu').
+    '''
+    free = gpu_free_memory() if device == 'gpu' else None
+    if free is None:
+        device, free = 'cpu', host_free_memory()
+    per_sample = sample_bytes(kind, model)
+    if free is None:
+        print('Cannot probe the free memory, using batch size %d.' %DEFAULT_BATCH_SIZE)
+        return DEFAULT_BATCH_SIZE
+    batch_size = 1
+    while batch_size*2 <= MAX_BATCH_SIZE and batch_size*2*per_sample <= free*mem_fraction:
+        batch_size *= 2
+    print('Batch size %d (%s: %.1f GB free, %.1f MB per sample).'
+          %(batch_size, device, free/2**30, per_sample/2**20))
+    return batch_size
+
+def is_out_of_memory(e):
+    if isinstance(e, MemoryError):
+        return True
+    # TF ResourceExhaustedError and host MemoryError (also as the repr sent back
+    # by the model server) and onnxruntime allocation failures, without
+    # importing them
+    msg = type(e).__name__ + str(e)
+    return any(k in msg for k in ('ResourceExhausted', 'MemoryError', 'OOM', 'Failed to allocate', 'bad_alloc'))
+
+class Predictor:
+    '''
+    Callable batch -> model output, running predict_fn(batch, batch_size).
+    When the prediction runs out of memory, batch_size is halved and the
+    batch is retried. batch_size is the size currently used.
+    '''
+    def __init__(self, predict_fn, batch_size):
+        self.predict_fn = predict_fn
+        self.batch_size = batch_size
+
+    def __call__(self, batch):
+        while True:
+            try:
+                return self.predict_fn(batch, self.batch_size)
+            except Exception as e:
+                if self.batch_size == 1 or not is_out_of_memory(e):
+                    raise
+                self.batch_size //= 2
+                print('Out of memory, retrying with batch size %d.' %self.batch_size)
+
+def get_predictor(kind, model_file, batch_size=DEFAULT_BATCH_SIZE, socket_path=None, backend='keras',
+                  intra_op_threads=0, inter_op_threads=0, use_server=True, mem_fraction=0.5):
+    '''
+    Predictor for the model. With the keras backend: through the model server
+    if it is running on socket_path (default: model_server.default_socket()),
+    else a local model. With the onnx backend: a local onnxruntime session.
+    use_server=False always loads a local model.
+    batch_size='auto' picks the batch size from mem_fraction of the free memory.
+    '''
+    if backend == 'onnx':
+        from cpu_backend import load_onnx_predictor
+        onnx_predict = load_onnx_predictor(os.path.abspath(model_file), intra_op_threads, inter_op_threads)
+        if batch_size == 'auto':
+            batch_size = auto_batch_size(kind, mem_fraction=mem_fraction)
+        return Predictor(lambda batch, bs: np.concatenate([onnx_predict(batch[i:i+bs])
+                                                           for i in range(0, len(batch), bs)]), batch_size)
+    if use_server:
+        from model_server import remote_predictor
+        predictor = remote_predictor(kind, model_file, socket_path=socket_path)
+        if predictor is not None:
+            print('Using the model server for %s.' %kind)
+            if batch_size == 'auto':
+                batch_size = auto_batch_size(kind, device='gpu', mem_fraction=mem_fraction)
+            return Predictor(predictor, batch_size)
+    model = load_assess_model(kind, os.path.abspath(model_file))
+    if batch_size == 'auto':
+        batch_size = auto_batch_size(kind, model, device='gpu', mem_fraction=mem_fraction)
+    return Predictor(lambda batch, bs: model.predict(batch, batch_size=bs), batch_size)
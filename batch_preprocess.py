@@ -0,0 +1,66 @@
+'''
+Batch preprocessing of the images before feeding into the CNN, shared by
+MicAssess and 2DAssess.
+A whole (N, H, W) stack is normalized per sample (center to 0, divide by std)
+in one vectorized pass and multiplied by a circular mask, which is computed
+once per image shape and cached. The output goes into a buffer that is
+allocated once per image shape and reused by the next call, so it must be
+consumed (e.g. predicted) before preprocess_batch is called again.
+'''
+
+from functools import lru_cache
+import numpy as np
+
+_buffers = {}
+
+@lru_cache(maxsize=None)
+def circular_mask(h, w):
+    '''
+    Boolean mask of the largest circle around the middle of an h x w image
+    (same as create_circular_mask with the default center and radius).
+    '''
+    center = [int(w/2), int(h/2)]
+    radius = min(center[0], center[1], w-center[0], h-center[1])
+    Y, X = np.ogrid[:h, :w]
+    mask = (X - center[0])**2 + (Y - center[1])**2 <= radius**2
+    mask.flags.writeable = False
+    return mask
+
+@lru_cache(maxsize=None)
+def _outside_mask(h, w):
+    outside = ~circular_mask(h, w)
+    outside.flags.writeable = False
+    return outside
+
+def _buffer(n, h, w):
+    buf = _buffers.get((h, w))
+    if buf is None or len(buf) < n:
+        buf = _buffers[(h, w)] = np.empty((n, h, w), dtype='float32')
+    return buf[:n]
+
+def crop_square(stack):
+    '''
+    Center square (short edge) of every image of an (N, H, W) stack, as a view.
+    '''
+    h, w = stack.shape[1:3]
+    s = min(h, w)
+    y, x = h//2 - s//2, w//2 - s//2
+    return stack[:, y:y+s, x:x+s]
+
+def preprocess_batch(stack, mask=True, out=None):
+    '''
+    Center every image of an (N, H, W) stack to 0 and divide by its std, then
+    apply the circular mask to make it rotatable (unless mask=False).
+    Returns a float32 (N, H, W) array, written to out if given, else to the
+    reusable buffer.
+    '''
+    n, h, w = stack.shape
+    if out is None:
+        out = _buffer(n, h, w)
+    mean = stack.mean(axis=(1, 2), dtype='float64')
+    np.subtract(stack, mean[:, None, None].astype('float32'), out=out, casting='unsafe')
+    var = np.einsum('nij,nij->n', out, out, dtype='float64') / (h*w)
+    out /= np.sqrt(var).astype('float32')[:, None, None]
+    if mask:
+        np.copyto(out, 0, where=_outside_mask(h, w))
+    return out
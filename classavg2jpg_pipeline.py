@@ -8,11 +8,11 @@ The name of the jpg file would be "particlename_diamxxkxx_classnumber.jpg"
 """
 
 import os
-import mrcfile
 import numpy as np
 from PIL import Image
 import argparse
 import shutil
+from mrc_io import read_mrc
 
 def setupParserOptions():
     ap = argparse.ArgumentParser()
@@ -25,59 +25,72 @@ def setupParserOptions():
     args = vars(ap.parse_args())
     return args
 
+def _first_hit(hit):
+    # index of the first True of every row, 0 if there is none
+    return np.where(hit.any(axis=1), hit.argmax(axis=1), 0)
+
+def border_edges(stack):
+    '''
+    Width of the empty border of every image of an (N, H, W) stack, from
+    all the row and column sums at once (same rule as the original loops).
+    '''
+    h, w = stack.shape[1:3]
+    rows = stack.sum(axis=2)
+    cols = stack.sum(axis=1)
+    fwd_w, fwd_h = np.arange(w), np.arange(h)
+    # scanning from the end visits index 0 first (img[-0] is img[0])
+    rev_rows, rev_cols_w, rev_cols_h = -fwd_w % h, -fwd_w % w, -fwd_h % w
+    edge_l = _first_hit((rows[:, fwd_w] > 1e-7) | (cols[:, fwd_w] < -1e-7))
+    edge_r = _first_hit((rows[:, rev_rows] > 1e-7) | (cols[:, rev_cols_w] < -1e-7))
+    edge_t = _first_hit(np.abs(cols[:, fwd_h]) > 1e-7)
+    edge_b = _first_hit(np.abs(cols[:, rev_cols_h]) > 1e-7)
+    return np.minimum.reduce([edge_l, edge_r, edge_t, edge_b])
+
 def cutbyradius(img):
-    h = img.shape[0]
-    w = img.shape[1]
-    # empty_val = img[0,0] # because the image is already masked (2d class avg), the [0,0] point must be empty
-    edge_l = 0
-    for i in range(w):
-        if np.sum(img[i,:]) > 1e-7 or np.sum(img[:,i]) < -1e-7:
-            edge_l = i
-            break
-    edge_r = 0
-    for ii in range(w):
-        if np.sum(img[-ii,:]) > 1e-7 or np.sum(img[:,-ii]) < -1e-7:
-            edge_r = ii
-            break
-    edge_t = 0
-    for j in range(h):
-        if np.sum(img[:,j]) > 1e-7 or np.sum(img[:,j]) < -1e-7:
-            edge_t = j
-            break
-    edge_b = 0
-    for jj in range(h):
-        if np.sum(img[:,-jj]) > 1e-7 or np.sum(img[:,-jj]) < -1e-7:
-            edge_b = jj
-            break
-    edge = min(edge_l, edge_r, edge_t, edge_b)
-    new_img = img[edge:h-edge+1, edge:w-edge+1]
-    return new_img
+    '''
+    Remove the empty border of a class average (H, W), or of every class of
+    an (N, H, W) stack, which gives a list of images.
+    '''
+    if img.ndim == 2:
+        return cutbyradius(img[np.newaxis])[0]
+    h, w = img.shape[1:3]
+    return [im[edge:h-edge+1, edge:w-edge+1] for im, edge in zip(img, border_edges(img))]
+
+def classavg_images(avg_mrc):
+    '''
+    Class numbers (starting from 1) and uint8 images of the non-empty class
+    averages of the stack, with the edges removed.
+    '''
+    if len(avg_mrc.shape) == 2:
+        avg_mrc = avg_mrc[np.newaxis]
+    total = avg_mrc.sum(axis=(1, 2))
+    class_nums = np.flatnonzero((total > 1e-7) | (total < -1e-7))
+    images = []
+    for new_img in cutbyradius(avg_mrc[class_nums]):
+        new_img = ((new_img-new_img.min())/((new_img.max()-new_img.min())+1e-7)*255).astype('uint8')
+        images.append(new_img)
+    return (class_nums + 1).tolist(), images
+
+def classavg_batch(images, size=256):
+    '''
+    (N, size, size) uint8 stack of the class average images, resized with
+    Lanczos like the Keras generator of 2DAssess does.
+    '''
+    stack = np.empty((len(images), size, size), dtype='uint8')
+    for i, img in enumerate(images):
+        stack[i] = np.asarray(Image.fromarray(img).resize((size, size), Image.LANCZOS))
+    return stack
 
 def save_mrcs(wkdir, **args):
     print('Converting mrcs to jpg....')
     os.chdir(wkdir) # navigate to the par dir of input file
-    # try:
-    #     shutil.rmtree(args['output'])
-    # except OSError:
-    #     pass
-    # os.makedirs(args['output'], exist_ok=True)
     os.mkdir(os.path.join(args['output'], 'data'))
-
-    # avg_mrc = mrcfile.open(os.path.basename(args['input'])).data
-    avg_mrc = mrcfile.open(args['input']).data
-    if len(avg_mrc.shape) == 3:
-        num_part = avg_mrc.shape[0]
-    elif len(avg_mrc.shape) == 2:
-        num_part = 1
-
-    for i in range(num_part):
-        new_img = avg_mrc[i,:,:]
-        if np.sum(new_img) > 1e-7 or np.sum(new_img) < -1e-7:
-            new_img = cutbyradius(new_img)
-            new_img = ((new_img-new_img.min())/((new_img.max()-new_img.min())+1e-7)*255).astype('uint8')
-            new_img = Image.fromarray(new_img)
-            new_img = new_img.convert("L")
-            new_img.save(os.path.join(args['output'], 'data', (args['name'] + '_' + str(i+1) + '.jpg')))
+    avg_mrc = read_mrc(args['input'])
+    class_nums, images = classavg_images(avg_mrc)
+    for i, new_img in zip(class_nums, images):
+        new_img = Image.fromarray(new_img)
+        new_img = new_img.convert("L")
+        new_img.save(os.path.join(args['output'], 'data', (args['name'] + '_' + str(i) + '.jpg')))
 
 if __name__ == '__main__':
     args = setupParserOptions()
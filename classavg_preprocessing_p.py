@@ -1,12 +1,14 @@
 '''
 Preprocessing of the image before feeding into the CNN.
+Single image versions of batch_preprocess.preprocess_batch.
 '''
 
 import numpy as np
-from scipy import ndimage
-import pandas as pd
+from batch_preprocess import preprocess_batch, circular_mask
 
 def create_circular_mask(h, w, center=None, radius=None):
+    if center is None and radius is None:
+        return circular_mask(h, w)
     if center is None: # use the middle of the image
         center = [int(w/2), int(h/2)]
     if radius is None: # use the smallest distance between the center and image walls
@@ -27,6 +29,6 @@ def preprocess(img):
     Center to 0 and divide by std to normalize.
     And then apply a circular mask to make it rotatable.
     '''
-    norm_img = (img - np.mean(img))/np.std(img)
-    masked_img = mask_img(norm_img)
-    return masked_img
+    stack = img.reshape((1,) + img.shape[:2])
+    out = preprocess_batch(stack, out=np.empty(stack.shape, dtype='float32'))[0]
+    return out.reshape(out.shape + img.shape[2:])
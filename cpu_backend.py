@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+'''
+CPU inference backend for MicAssess and 2DAssess with ONNX Runtime.
+The Keras .h5 model is exported once to an ONNX graph (optionally quantized to
+int8), which then runs on the CPU partition with tunable intra-op and inter-op
+threading, instead of waiting for a GPU node.
+
+Needs keras2onnx (export only) and onnxruntime.
+
+To use: python cpu_backend.py export -k micassess -m micassess_051419.h5 -o micassess_051419.onnx [--int8]
+        python cpu_backend.py check -k micassess -m micassess_051419.h5 --onnx micassess_051419.onnx [--data batch.npy]
+        python cpu_backend.py bench -k micassess --onnx micassess_051419.onnx -b 16 --intra_op_threads 24
+Then: python micassess.py -i micrographs.star --backend onnx -m micassess_051419.onnx
+'''
+
+import os
+import time
+import argparse
+import numpy as np
+from assess_models import MODEL_INPUT_SHAPES
+
+def setupParserOptions():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('action', choices=['export', 'check', 'bench'],
+                    help="export: convert the .h5 model to ONNX. check: compare the ONNX outputs to Keras. bench: measure the ONNX throughput.")
+    ap.add_argument('-k', '--kind', default='micassess', choices=['micassess', '2dassess'],
+                    help="Which model. Default is micassess.")
+    ap.add_argument('-m', '--model',
+                    help="Path to the Keras model.h5 file.")
+    ap.add_argument('-o', '--output',
+                    help="Only used in export. Path of the .onnx file to write.")
+    ap.add_argument('--onnx',
+                    help="Path to the .onnx file for check and bench.")
+    ap.add_argument('--int8', action='store_true',
+                    help="Only used in export. Also quantize the weights to int8 (dynamic quantization).")
+    ap.add_argument('--data', default=None,
+                    help="Only used in check. .npy file of preprocessed inputs (N, H, W, 1). Random inputs are used if not given.")
+    ap.add_argument('-b', '--batch_size', type=int, default=16,
+                    help="Batch size for check and bench. Default is 16.")
+    ap.add_argument('--repeats', type=int, default=5,
+                    help="Only used in bench. Number of timed batches. Default is 5.")
+    ap.add_argument('--intra_op_threads', type=int, default=0,
+                    help="Threads used inside an operator. Default is 0 (all cores).")
+    ap.add_argument('--inter_op_threads', type=int, default=0,
+                    help="Threads used to run independent operators in parallel. Default is 0 (let onnxruntime decide).")
+    args = vars(ap.parse_args())
+    return args
+
+def export_onnx(kind, model_file, onnx_file, int8=False):
+    '''
+    Export the Keras model to ONNX, and quantize it to int8 if asked.
+    '''
+    try:
+        import keras2onnx
+    except ImportError:
+        raise ImportError('Exporting to ONNX needs keras2onnx (pip install keras2onnx).')
+    from assess_models import load_assess_model
+    model = load_assess_model(kind, model_file)
+    onnx_model = keras2onnx.convert_keras(model, model.name)
+    keras2onnx.save_model(onnx_model, onnx_file)
+    if int8:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        fp32_file = onnx_file + '.fp32'
+        os.replace(onnx_file, fp32_file)
+        quantize_dynamic(fp32_file, onnx_file, weight_type=QuantType.QInt8)
+        os.remove(fp32_file)
+    print('Exported %s to %s.' %(model_file, onnx_file))
+
+def load_onnx_predictor(onnx_file, intra_op_threads=0, inter_op_threads=0):
+    '''
+    Predictor (batch -> model output) running the ONNX graph on the CPU.
+    '''
+    try:
+        import onnxruntime as ort
+    except ImportError:
+        raise ImportError('The ONNX backend needs onnxruntime (pip install onnxruntime).')
+    opts = ort.SessionOptions()
+    opts.intra_op_num_threads = intra_op_threads
+    opts.inter_op_num_threads = inter_op_threads
+    if inter_op_threads > 1:
+        opts.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+    sess = ort.InferenceSession(onnx_file, sess_options=opts, providers=['CPUExecutionProvider'])
+    input_name = sess.get_inputs()[0].name
+
+    def predict(batch):
+        return sess.run(None, {input_name: np.asarray(batch, dtype='float32')})[0]
+    return predict
+
+def test_inputs(kind, data=None, n=16):
+    if data is not None:
+        return np.load(data).astype('float32')
+    return np.random.RandomState(0).standard_normal((n,) + MODEL_INPUT_SHAPES[kind]).astype('float32')
+
+def check_accuracy(kind, model_file, onnx_file, data=None, batch_size=16, threshold=0.1, **args):
+    '''
+    Compare the ONNX outputs to the Keras reference outputs on the same inputs.
+    Returns the max absolute difference and the fraction of same labels.
+    '''
+    from assess_models import load_assess_model
+    x = test_inputs(kind, data, batch_size)
+    ref = load_assess_model(kind, model_file).predict(x, batch_size=batch_size)
+    predictor = load_onnx_predictor(onnx_file, args.get('intra_op_threads', 0), args.get('inter_op_threads', 0))
+    out = np.concatenate([predictor(x[i:i+batch_size]) for i in range(0, len(x), batch_size)])
+    if kind == 'micassess':
+        same = np.mean((ref.ravel() > threshold) == (out.ravel() > threshold))
+    else:
+        same = np.mean(np.argmax(ref, axis=1) == np.argmax(out, axis=1))
+    max_diff = float(np.max(np.abs(ref - out)))
+    print('Max abs difference to Keras: %.2e. Same label: %.1f%% of %d inputs.' %(max_diff, 100*same, len(x)))
+    return max_diff, same
+
+def benchmark(kind, onnx_file, batch_size=16, repeats=5, intra_op_threads=0, inter_op_threads=0):
+    '''
+    Throughput of the ONNX backend in images per second.
+    '''
+    predictor = load_onnx_predictor(onnx_file, intra_op_threads, inter_op_threads)
+    x = test_inputs(kind, n=batch_size)
+    predictor(x) # warm up
+    start = time.time()
+    for _ in range(repeats):
+        predictor(x)
+    rate = batch_size * repeats / (time.time() - start)
+    print('%.1f images/s (batch size %d, intra-op threads %d, inter-op threads %d).'
+          %(rate, batch_size, intra_op_threads, inter_op_threads))
+    return rate
+
+def main(**args):
+    if args['action'] == 'export':
+        export_onnx(args['kind'], args['model'], args['output'], args['int8'])
+    elif args['action'] == 'check':
+        check_accuracy(args['kind'], args['model'], args['onnx'], args['data'], args['batch_size'],
+                       intra_op_threads=args['intra_op_threads'], inter_op_threads=args['inter_op_threads'])
+    elif args['action'] == 'bench':
+        benchmark(args['kind'], args['onnx'], args['batch_size'], args['repeats'],
+                  args['intra_op_threads'], args['inter_op_threads'])
+
+if __name__ == '__main__':
+    args = setupParserOptions()
+    main(**args)
@@ -0,0 +1,50 @@
+'''
+Fourier downsampling of micrographs.
+Uses scipy.fft when it is available (multithreaded with workers > 1, and its
+plan cache is reused across micrographs of the same shape), numpy.fft otherwise.
+The cropped spectrum is written into a workspace buffer that is allocated once
+per output shape and reused, instead of concatenating two spectrum slices.
+float32=True does the transforms in single precision, which halves the memory.
+'''
+
+import numpy as np
+try:
+    import scipy.fft as _fft
+    HAS_SCIPY_FFT = True
+except ImportError:
+    import numpy.fft as _fft
+    HAS_SCIPY_FFT = False
+
+_workspaces = {}
+
+def _workspace(shape, dtype):
+    key = (shape, np.dtype(dtype))
+    if key not in _workspaces:
+        _workspaces[key] = np.empty(shape, dtype=dtype)
+    return _workspaces[key]
+
+def _rfft2(x, workers):
+    if HAS_SCIPY_FFT:
+        return _fft.rfft2(x, workers=workers)
+    return _fft.rfft2(x)
+
+def _irfft2(F, s, workers):
+    if HAS_SCIPY_FFT:
+        return _fft.irfft2(F, s=s, workers=workers, overwrite_x=True)
+    return _fft.irfft2(F, s=s)
+
+def downsample(x, height=494, float32=False, workers=1):
+    ''' Downsample 2d array using fourier transform '''
+    m,n = x.shape[-2:]
+    factor = m/height
+    width = round(n/factor/2)*2
+    x = np.asarray(x, dtype=np.float32 if float32 else np.float64)
+    F = _rfft2(x, workers)
+    # Fourier crop: keep the low frequencies from the top and the bottom rows.
+    F_crop = _workspace((height, width//2+1), F.dtype)
+    F_crop[:height//2] = F[0:height//2, 0:width//2+1]
+    F_crop[height//2:] = F[-height//2:, 0:width//2+1]
+    f = _irfft2(F_crop, (height, width), workers)
+    if float32:
+        f = f.astype(np.float32, copy=False)
+    return f
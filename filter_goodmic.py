@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 import os
-import pandas as pd
 import subprocess
 import argparse
 import shutil
+from star_io import star2df
+from star_select import build_index, select_mask
 
 '''
 Using the star file to filter out bad micrographs in the directory containing the
@@ -36,35 +37,13 @@ def prepare(wkdir, input, output):
     cmd = 'ln %s %s'%(input_mrc, output)
     subprocess.run(cmd, shell=True)
 
-def star2df(starfile):
-    with open(starfile) as f:
-        star = f.readlines()
-
-    for i in range(len(star)):
-        if 'loop_' in star[i]:
-            start_idx = i
-            break
-    key_idx = []
-    for j in range(start_idx+1, len(star)):
-        if star[j].startswith('_'):
-            key_idx.append(j)
-
-    keys = [star[ii] for ii in key_idx]
-    star_df = star[1+key_idx[-1]:]
-    star_df = [x.split() for x in star_df]
-    star_df = pd.DataFrame(star_df)
-    star_df = star_df.dropna()
-    star_df.columns = keys
-
-    return star_df
-
 def filter_bad(good_star, input, output):
-    good_mic_df = star2df(good_star)
-    good_mic_list = good_mic_df['_rlnMicrographName\n'].tolist()
+    good_mic_df = star2df(good_star, columns=['rlnMicrographName'], cache=True)
+    good_mic_index = build_index(good_mic_df['rlnMicrographName'])
     mrc_list = os.listdir(output)
-    for f in mrc_list:
-        ff = os.path.join(input, f)
-        if ff not in good_mic_list:
+    is_good = select_mask([os.path.join(input, f) for f in mrc_list], good_mic_index)
+    for f, good in zip(mrc_list, is_good):
+        if not good:
             # print(f)
             os.remove(os.path.join(output, f))
 
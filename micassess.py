@@ -9,23 +9,47 @@ INPUTS: Input directory of the micrographs in jpg format.
         Path to the .h5 model file.
 
 To use: python micassess.py -i <input_path> -m <model_path>
+With --mode array, the downsampled micrographs are kept in memory and fed to the
+model directly, without writing and reading back the jpg files.
+With --mode stream, conversion workers feed batches to the model through a
+bounded queue while it predicts, and the model is loaded during the first
+conversions, so conversion and prediction overlap.
+The score of every micrograph is saved to micassess_scores.npz, so the output can
+be regenerated at another threshold with micassess_scores.py.
+With --incremental, only the micrographs that are not in micassess_scores.npz, or
+whose size or mtime changed, are converted and assessed (in memory), and their
+scores are merged with the earlier ones.
+With --watch, MicAssess keeps running during data collection: it polls the
+micrograph directory (--watch_dir) or the growing input star file for new
+micrographs, assesses them with the model kept in memory, and appends the good
+ones to the output star file.
+If the model server (model_server.py) is running, the predictions are sent to it
+instead of loading the model in this process.
+With --shards N, the micrographs are split into N shards assessed by N worker
+processes, each with its own model copy, pinned to its own share of the cores
+and limited to that many threads. The scores are merged back in input order.
 '''
 
-from keras.models import *
-from keras.preprocessing.image import ImageDataGenerator
-from keras.optimizers import *
-from keras import backend as keras
 import numpy as np
 import os
 import argparse
 from shutil import copy2
 import glob
 import pickle
-from mrc2jpg_p import mrc2jpg, star2miclist
+from mrc2jpg_p import mrc2jpg, mrc2array, mrc2arrays, mrc2batches, conversion_pool
+from star_io import star2miclist, star2df, append_star_rows
+from star_select import keep_rows
+from micassess_scores import make_scores, merge_scores, save_scores, load_scores, \
+    write_micassess_star, stat_micrographs, stale_mask
 import multiprocessing as mp
 import shutil
 import pandas as pd
 import sys
+from batch_preprocess import preprocess_batch, crop_square, circular_mask
+from assess_models import get_predictor, batch_size_arg, DEFAULT_BATCH_SIZE
+import queue
+import threading
+import time
 
 def setupParserOptions():
     ap = argparse.ArgumentParser()
@@ -35,14 +59,48 @@ def setupParserOptions():
                     help='Path to the model.h5 file.')
     ap.add_argument('-o', '--output', default='micrographs_micassess.star',
                     help="Name of the output star file. Default is micrographs_micassess.star.")
-    ap.add_argument('-b', '--batch_size', type=int, default=32,
-                    help="Batch size used in prediction. Default is 32. If memory error/warning appears, try lower this number to 16, 8, or even lower.")
+    ap.add_argument('-b', '--batch_size', type=batch_size_arg, default=32,
+                    help="Batch size used in prediction, or auto to choose it from the free memory. Default is 32. The batch size is halved automatically if the prediction runs out of memory.")
     ap.add_argument('-t', '--threshold', type=float, default=0.1,
                     help="Threshold for classification. Default is 0.1. Higher number will cause more good micrographs being classified as bad.")
+    ap.add_argument('--float32', action='store_true',
+                    help="Do the Fourier downsampling of the micrographs in single precision (half the memory).")
+    ap.add_argument('--fft_workers', type=int, default=1,
+                    help="Number of threads of each FFT during conversion. Default is 1.")
+    ap.add_argument('--mode', default='jpg', choices=['jpg', 'array', 'stream'],
+                    help="jpg: convert the micrographs to jpg files first (default). array: keep the downsampled micrographs in memory and skip the jpg files. stream: like array, but predict while converting.")
+    ap.add_argument('--queue_size', type=int, default=4,
+                    help="Only used in stream mode. Max number of converted batches waiting for the model. Default is 4.")
+    ap.add_argument('--scores', default='micassess_scores.npz',
+                    help="Name of the file to store the score of every micrograph, in the directory of the input star file. Default is micassess_scores.npz.")
+    ap.add_argument('--incremental', action='store_true',
+                    help="Only assess new or changed micrographs and merge with the scores of earlier runs. Uses the stream mode if --mode is jpg.")
+    ap.add_argument('--socket', default=None,
+                    help="Unix socket of the model server. Default is $CRYOASSESS_SOCKET or /tmp/cryoassess_<uid>.sock. The model is loaded locally if no server is running.")
+    ap.add_argument('--backend', default='keras', choices=['keras', 'onnx'],
+                    help="keras: run the .h5 model with Keras (default). onnx: run an ONNX export of the model on the CPU (see cpu_backend.py), -m is then the .onnx file.")
+    ap.add_argument('--intra_op_threads', '--threads', type=int, default=0,
+                    help="Only used with --backend onnx. Threads used inside an operator. Default is 0 (all cores).")
+    ap.add_argument('--inter_op_threads', type=int, default=0,
+                    help="Only used with --backend onnx. Threads used to run independent operators in parallel. Default is 0.")
+    ap.add_argument('--shards', type=int, default=0,
+                    help="Split the micrographs into this many shards, converted and assessed in parallel by worker processes pinned to their share of the cores (in memory, like --mode array). Default is 0 (no sharding).")
+    ap.add_argument('--watch', action='store_true',
+                    help="Keep running and assess new micrographs as they arrive. With --incremental, resume the output and scores of an earlier run.")
+    ap.add_argument('--watch_dir', default=None,
+                    help="Only used with --watch. Directory to watch for new mrc files. If not given, the input star file is watched instead.")
+    ap.add_argument('--interval', type=float, default=60,
+                    help="Only used with --watch. Seconds between two polls. Default is 60.")
+    ap.add_argument('--settle', type=float, default=30,
+                    help="Only used with --watch. A micrograph is assessed once it has not been modified for this many seconds. Default is 30.")
+    ap.add_argument('--idle_timeout', type=float, default=0,
+                    help="Only used with --watch. Stop after this many seconds without new micrographs. Default is 0 (run until killed).")
     args = vars(ap.parse_args())
     return args
 
 def create_circular_mask(h, w, center=None, radius=None):
+    if center is None and radius is None:
+        return circular_mask(h, w)
     if center is None: # use the middle of the image
         center = [int(w/2), int(h/2)]
     if radius is None: # use the smallest distance between the center and image walls
@@ -70,12 +128,11 @@ def preprocess(img):
     Crop the images to make it square.
     Center to 0 and divide by std to normalize.
     And then apply a circular mask to make it rotatable.
+    Single image (H, W) or (H, W, 1) version of preprocess_batch.
     '''
-    short_edge = min(img.shape[0], img.shape[1])
-    square_img = crop_center(img, short_edge, short_edge)
-    norm_img = (square_img - np.mean(square_img))/np.std(square_img)
-    masked_img = mask_img(norm_img)
-    return masked_img
+    stack = crop_square(img.reshape((1,) + img.shape[:2]))
+    out = preprocess_batch(stack, out=np.empty(stack.shape, dtype='float32'))[0]
+    return out.reshape(out.shape + img.shape[2:])
 
 def copygoodfile(file):
     copy2(file, 'pred_good')
@@ -83,61 +140,294 @@ def copygoodfile(file):
 def copybadfile(file):
     copy2(file, 'pred_bad')
 
-def star2df(starfile):
-    with open(starfile) as f:
-        star = f.readlines()
-
-    for i in range(len(star)):
-        if 'loop_' in star[i]:
-            start_idx = i
-            break
-    key_idx = []
-    for j in range(start_idx+1, len(star)):
-        if star[j].startswith('_'):
-            key_idx.append(j)
-
-    keys = [star[ii] for ii in key_idx]
-    star_df = star[1+key_idx[-1]:]
-    star_df = [x.split() for x in star_df]
-    star_df = pd.DataFrame(star_df)
-    star_df = star_df.dropna()
-    star_df.columns = keys
-
-    return star_df
-
-def df2star(star_df, star_name):
-    header = ['data_ \n', '\n', 'loop_ \n']
-    keys = star_df.columns.tolist()
-
-    with open(star_name, 'w') as f:
-        for l_0 in header:
-            f.write(l_0)
-        for l_1 in keys:
-            f.write(l_1)
-        for i in range(len(star_df)):
-            s = '  '.join(star_df.iloc[i].tolist())
-            f.write(s + ' \n')
+def load_micassess_predictor(**args):
+    return get_predictor('micassess', args['model'], batch_size=args['batch_size'], socket_path=args['socket'],
+                         backend=args['backend'], intra_op_threads=args['intra_op_threads'],
+                         inter_op_threads=args['inter_op_threads'])
+
+def predict_stack(predictor, stack):
+    '''
+    Predict an (N, 494, 494) stack of uint8 micrographs batch by batch, with
+    the batch size of the predictor.
+    '''
+    prob = []
+    i = 0
+    while i < len(stack):
+        batch_size = predictor.batch_size
+        batch = preprocess_batch(crop_square(stack[i:i+batch_size]))
+        i += batch_size
+        prob.append(predictor(batch[..., np.newaxis]))
+    if not prob:
+        return np.empty(0)
+    return np.concatenate(prob).ravel()
+
+def micrographs_to_assess(**args):
+    '''
+    Micrographs of the input star file to assess, and the earlier scores.
+    Without --incremental, all micrographs are assessed and old scores are ignored.
+    '''
+    wkdir = os.path.abspath(os.path.dirname(args['input'])) # par dir of input file
+    os.chdir(wkdir)
+    mic_list = star2miclist(os.path.basename(args['input']), cache=True)
+    if not args.get('incremental') or not os.path.isfile(args['scores']):
+        return wkdir, mic_list, None
+    old_scores = load_scores(args['scores'])
+    sizes, mtimes = stat_micrographs(mic_list)
+    stale = stale_mask(old_scores, mic_list, sizes, mtimes)
+    new_list = [mic for mic, s in zip(mic_list, stale) if s]
+    print('%d of %d micrographs are new or changed.' %(len(new_list), len(mic_list)))
+    return wkdir, new_list, old_scores
+
+def predict_in_memory(**args):
+    '''
+    Convert the micrographs in memory and predict them without jpg files.
+    '''
+    wkdir, mic_list, old_scores = micrographs_to_assess(**args)
+    if not mic_list:
+        write_results(wkdir, [], np.empty(0), old_scores, **args)
+        return
+    names, stack = mrc2arrays(mic_list, **args)
+    print('Start to assess micrographs with MicAssess.')
+    predictor = load_micassess_predictor(**args)
+    prob = predict_stack(predictor, stack)
+    write_results(wkdir, names, prob, old_scores, **args)
+
+def predict_streaming(**args):
+    '''
+    Convert and predict at the same time: a producer thread converts the
+    micrographs into a bounded queue of batches, which the model consumes.
+    '''
+    wkdir, mic_list, old_scores = micrographs_to_assess(**args)
+    if not mic_list:
+        write_results(wkdir, [], np.empty(0), old_scores, **args)
+        return
+    batch_queue = queue.Queue(maxsize=args['queue_size'])
+    convert_batch = DEFAULT_BATCH_SIZE if args['batch_size'] == 'auto' else args['batch_size']
+    pool = conversion_pool(**args) # forked here, before the model is loaded
+    producer = threading.Thread(target=mrc2batches, args=(mic_list, batch_queue, convert_batch, pool),
+                                kwargs={'float32': args['float32'], 'fft_workers': args['fft_workers']})
+    producer.daemon = True
+    producer.start()
+    try:
+        print('Start to assess micrographs with MicAssess.')
+        predictor = load_micassess_predictor(**args) # loads while the first batches are converted
+        names, prob = [], []
+        error = None
+        while True:
+            batch = batch_queue.get()
+            if batch is None:
+                break
+            if isinstance(batch, Exception):
+                error = batch
+                continue
+            names.extend(batch[0])
+            prob.append(predict_stack(predictor, batch[1]))
+        producer.join()
+    finally:
+        pool.terminate()
+    if error is not None:
+        # do not write partial results, the run must fail like the array mode
+        raise error
+    print('Conversion finished.')
+    prob = np.concatenate(prob) if prob else np.empty(0)
+    write_results(wkdir, names, prob, old_scores, **args)
+
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS')
+
+def spawn_pool(processes, threads):
+    '''
+    Spawned pool whose workers start with the numerical libraries limited to
+    threads threads. The variables must be in the environment the workers are
+    spawned with, since they re-import numpy before running any task.
+    '''
+    old_env = {var: os.environ.get(var) for var in THREAD_ENV_VARS}
+    os.environ.update({var: str(threads) for var in THREAD_ENV_VARS})
+    try:
+        return mp.get_context('spawn').Pool(processes)
+    finally:
+        for var, value in old_env.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+def pin_threads(cpus):
+    '''
+    Pin every thread of this process (including the BLAS threads already
+    started) to cpus; sched_setaffinity(0) alone only pins the calling thread.
+    '''
+    if not hasattr(os, 'sched_setaffinity'):
+        return
+    try:
+        tids = [int(t) for t in os.listdir('/proc/self/task')]
+    except OSError:
+        tids = [0]
+    for tid in tids:
+        try:
+            os.sched_setaffinity(tid, cpus)
+        except OSError: # the thread has exited
+            pass
+
+def limit_threads(n, backend='keras'):
+    '''
+    Limit the Keras (TF1) session of this process to n threads. Call before
+    the model is loaded.
+    '''
+    if backend == 'keras':
+        import tensorflow as tf
+        from keras import backend as K
+        K.set_session(tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=n,
+                                                       inter_op_parallelism_threads=1)))
+
+def assess_shard(mic_list, cpus, **args):
+    '''
+    Worker of the sharded mode: pin this process to cpus, then convert and
+    predict the micrographs of the shard batch by batch with a local model.
+    Returns the names of the converted micrographs and their scores.
+    '''
+    pin_threads(cpus)
+    n = len(cpus)
+    limit_threads(n, args['backend'])
+    predictor = get_predictor('micassess', args['model'], batch_size=args['batch_size'],
+                              backend=args['backend'], intra_op_threads=n, inter_op_threads=1,
+                              use_server=False, mem_fraction=0.5/args['n_shards'])
+    names, prob = [], []
+    i = 0
+    while i < len(mic_list):
+        arrays = [(mic, mrc2array(mic, float32=args['float32'], fft_workers=n))
+                  for mic in mic_list[i:i+predictor.batch_size]]
+        i += len(arrays)
+        arrays = [(mic, a) for mic, a in arrays if a is not None]
+        if arrays:
+            names.extend(mic for mic, a in arrays)
+            prob.append(predict_stack(predictor, np.stack([a for mic, a in arrays])))
+    return names, np.concatenate(prob) if prob else np.empty(0)
+
+def predict_sharded(**args):
+    '''
+    Split the micrographs into contiguous shards and assess them in parallel
+    worker processes (spawned, so each gets a clean Keras/TF state).
+    '''
+    wkdir, mic_list, old_scores = micrographs_to_assess(**args)
+    if not mic_list:
+        write_results(wkdir, [], np.empty(0), old_scores, **args)
+        return
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(mp.cpu_count()))
+    n_shards = max(1, min(args['shards'], len(cpus), len(mic_list)))
+    cpu_shards = [c.tolist() for c in np.array_split(cpus, n_shards)]
+    mic_shards = [m.tolist() for m in np.array_split(np.asarray(mic_list, dtype=object), n_shards)]
+    print('Start to assess micrographs with MicAssess in %d shards of %d cores.' %(n_shards, len(cpu_shards[-1])))
+    with spawn_pool(n_shards, max(len(c) for c in cpu_shards)) as pool:
+        results = [pool.apply_async(assess_shard, (m, c), dict(args, n_shards=n_shards))
+                   for m, c in zip(mic_shards, cpu_shards)]
+        results = [r.get() for r in results]
+    names = [name for shard_names, _ in results for name in shard_names]
+    prob = np.concatenate([shard_prob for _, shard_prob in results])
+    write_results(wkdir, names, prob, old_scores, **args)
+
+def watched_micrographs(wkdir, **args):
+    '''
+    Micrographs currently in the watched directory, or in the input star file,
+    as a star DataFrame with paths relative to wkdir.
+    '''
+    if args['watch_dir'] is not None:
+        mrc_list = sorted(glob.glob(os.path.join(args['watch_dir'], '*.mrc')))
+        return pd.DataFrame({'rlnMicrographName': [os.path.relpath(f, wkdir) for f in mrc_list]})
+    if not os.path.isfile(os.path.basename(args['input'])):
+        return pd.DataFrame({'rlnMicrographName': []})
+    return star2df(os.path.basename(args['input']))
+
+def watch(**args):
+    '''
+    Poll for new micrographs, assess them with the model kept in memory, and
+    append the good ones to the output star file.
+    '''
+    wkdir = os.path.abspath(os.path.dirname(args['input'])) # par dir of input file
+    if args['watch_dir'] is not None:
+        args['watch_dir'] = os.path.abspath(args['watch_dir'])
+    os.chdir(wkdir)
+    scores = None
+    if args['incremental'] and os.path.isfile(args['scores']):
+        scores = load_scores(args['scores'])
+    else:
+        try:
+            os.remove(args['output'])
+        except OSError:
+            pass
+    pool = conversion_pool(**args) # one pool for all the polls, forked before the model is loaded
+    try:
+        predictor = load_micassess_predictor(**args)
+        print('Watching for new micrographs....')
+        last_new = time.time()
+        while True:
+            star_df = watched_micrographs(wkdir, **args)
+            mic_list = star_df['rlnMicrographName'].tolist()
+            sizes, mtimes = stat_micrographs(mic_list)
+            settled = (sizes >= 0) & (mtimes < (time.time() - args['settle']) * 1e9)
+            new = stale_mask(scores, mic_list, sizes, mtimes) & settled
+            new_list = [mic for mic, n in zip(mic_list, new) if n]
+            if new_list:
+                names, stack = mrc2arrays(new_list, pool=pool, **args)
+                prob_of = dict(zip(names, predict_stack(predictor, stack)))
+                # micrographs that cannot be converted get no score and are not retried
+                prob = np.array([prob_of.get(mic, np.nan) for mic in new_list])
+                new_scores = make_scores(new_list, prob, *stat_micrographs(new_list))
+                scores = new_scores if scores is None else merge_scores(scores, new_scores)
+                save_scores(args['scores'], scores)
+                goodlist = [mic for mic, p in zip(new_list, prob) if p > args['threshold']]
+                append_star_rows(keep_rows(star_df, 'rlnMicrographName', goodlist, key='basename'), args['output'])
+                print('%s: assessed %d new micrographs, %d good.' %(time.strftime('%H:%M:%S'), len(new_list), len(goodlist)))
+                last_new = time.time()
+            elif args['idle_timeout'] > 0 and time.time() - last_new > args['idle_timeout']:
+                break
+            time.sleep(args['interval'])
+    finally:
+        pool.terminate()
+    print('All finished!')
+
+def write_results(wkdir, names, prob, old_scores=None, stat=True, **args):
+    '''
+    Save the scores (merged with old_scores if given) and write the output star
+    file with the micrographs above the threshold.
+    stat: names are micrograph paths, store their size and mtime.
+    '''
+    os.chdir(wkdir)
+    sizes, mtimes = stat_micrographs(names) if stat else (None, None)
+    scores = make_scores(names, prob, sizes, mtimes)
+    if old_scores is not None:
+        scores = merge_scores(old_scores, scores)
+    save_scores(args['scores'], scores)
+    try:
+        os.remove(args['output'])
+    except OSError:
+        pass
+    write_micassess_star(os.path.basename(args['input']), load_scores(args['scores']), args['threshold'], args['output'])
+    print('All finished!')
 
 def predict(**args):
-    start_dir = os.getcwd()
+    wkdir = os.path.abspath(os.path.dirname(args['input'])) # par dir of input file
+    from keras.preprocessing.image import ImageDataGenerator
     print('Start to assess micrographs with MicAssess.')
-    model = load_model(args['model'])
-    batch_size = args['batch_size']
+    predictor = load_micassess_predictor(**args)
+    batch_size = predictor.batch_size
     test_data_dir = os.path.join(os.path.abspath(os.path.join(args['input'], os.pardir)), 'MicAssess') # MicAssess is in the par dir of input file
-    model.compile(optimizer = Adam(lr = 1e-4), loss = 'binary_crossentropy', metrics = ['accuracy'])
     test_datagen = ImageDataGenerator(
         preprocessing_function=preprocess)
     test_generator = test_datagen.flow_from_directory(test_data_dir, target_size=(494, 494), batch_size=batch_size, color_mode='grayscale', class_mode=None, shuffle=False)
-    prob = model.predict_generator(test_generator)
+    prob = np.concatenate([predictor(test_generator[i]) for i in range(len(test_generator))])
     print('Assessment finished. Copying files to good and bad directories....')
     os.chdir(test_data_dir)
     os.mkdir('pred_good')
     os.mkdir('pred_bad')
 
+    jpglist = sorted(glob.glob('data/*.jpg'))
     good_idx = np.where(prob > args['threshold'])[0]
     bad_idx = np.where(prob <= args['threshold'])[0]
-    goodlist = list(sorted(glob.glob('data/*.jpg'))[i] for i in good_idx)
-    badlist = list(sorted(glob.glob('data/*.jpg'))[i] for i in bad_idx)
+    goodlist = list(jpglist[i] for i in good_idx)
+    badlist = list(jpglist[i] for i in bad_idx)
 
     pool = mp.Pool(mp.cpu_count())
     pool.map(copygoodfile, [file for file in goodlist])
@@ -146,30 +436,25 @@ def predict(**args):
     shutil.rmtree('data') # after prediction, remove the data directory
 
     # write the output file
-    os.chdir(start_dir)
-    os.chdir(os.path.abspath(os.path.dirname(args['input']))) # navigate to the par dir of input file
-    try:
-        os.remove(args['output'])
-    except OSError:
-        pass
-    star_df = star2df(os.path.basename(args['input']))
-    goodlist_base = [os.path.basename(f)[:-4] for f in goodlist]
-    badindex = []
-    for i in range(len(star_df)):
-        if os.path.basename(star_df['_rlnMicrographName\n'][i])[:-4] not in goodlist_base:
-            badindex.append(i)
-    new_star_df = star_df.drop(badindex)
-    df2star(new_star_df, args['output'])
-    # with open('goodlist', 'wb') as f:
-    #     pickle.dump(goodlist, f)
-
-    print('All finished!')
+    write_results(wkdir, jpglist, prob.ravel(), stat=False, **args)
 
 if __name__ == '__main__':
     # os.environ["CUDA_VISIBLE_DEVICES"]="0"
     start_dir = os.getcwd()
     args = setupParserOptions()
     os.chdir(start_dir)
-    mrc2jpg(**args)
-    os.chdir(start_dir)
-    predict(**args)
+    if args['watch']:
+        watch(**args)
+        sys.exit()
+    if args['incremental'] and args['mode'] == 'jpg':
+        args['mode'] = 'stream'
+    if args['shards'] > 1:
+        predict_sharded(**args)
+    elif args['mode'] == 'array':
+        predict_in_memory(**args)
+    elif args['mode'] == 'stream':
+        predict_streaming(**args)
+    else:
+        mrc2jpg(**args)
+        os.chdir(start_dir)
+        predict(**args)
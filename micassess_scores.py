@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+'''
+Persistent store of the MicAssess scores (probability of being a good micrograph).
+The scores are kept in a compact .npz file keyed by micrograph basename, next to
+the input star file, so the output star file can be regenerated at any threshold
+without converting and predicting the micrographs again.
+The size and mtime of every micrograph are stored too, so an incremental run
+only needs to assess the micrographs that are new or changed.
+
+To use: python micassess_scores.py -i micrographs.star -t 0.2
+        python micassess_scores.py -i micrographs.star --curve 0,0.5,0.05
+'''
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from star_io import star2df, df2star
+from star_select import mic_basename
+
+SCORE_COLUMN = 'MicAssessScore'
+
+def setupParserOptions():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-i', '--input',
+                    help="Provide the path to the micrographs.star file that was assessed.")
+    ap.add_argument('-s', '--scores', default='micassess_scores.npz',
+                    help="Score file written by MicAssess, relative to the directory of the input star file. Default is micassess_scores.npz.")
+    ap.add_argument('-o', '--output', default='micrographs_micassess.star',
+                    help="Name of the output star file. Default is micrographs_micassess.star.")
+    ap.add_argument('-t', '--threshold', type=float, default=None,
+                    help="Threshold for classification. Regenerates the output star file.")
+    ap.add_argument('--curve', default=None,
+                    help="Report the number of good micrographs for a range of thresholds, given as start,stop,step (e.g. 0,0.5,0.05).")
+    args = vars(ap.parse_args())
+    return args
+
+def make_scores(names, prob, sizes=None, mtimes=None):
+    '''
+    Score dict keyed by micrograph basename. Without sizes and mtimes (e.g. in
+    jpg mode), the micrographs will be assessed again by an incremental run.
+    '''
+    n = len(names)
+    return {'names': np.asarray(mic_basename(names), dtype=str),
+            'prob': np.asarray(prob, dtype='float32').ravel(),
+            'size': np.full(n, -1, dtype='int64') if sizes is None else np.asarray(sizes, dtype='int64'),
+            'mtime_ns': np.full(n, -1, dtype='int64') if mtimes is None else np.asarray(mtimes, dtype='int64')}
+
+def merge_scores(old, new):
+    '''
+    Merge two score dicts, the new scores replace the old ones of the same micrograph.
+    '''
+    merged = {k: np.concatenate([old[k], new[k]]) for k in new}
+    # keep the last score of a micrograph that appears twice
+    _, last = np.unique(merged['names'][::-1], return_index=True)
+    keep = np.sort(len(merged['names']) - 1 - last)
+    return {k: v[keep] for k, v in merged.items()}
+
+def save_scores(score_file, scores):
+    '''
+    Save a score dict to an .npz file, atomically.
+    '''
+    empty = {k: v[:0] for k, v in scores.items()}
+    scores = merge_scores(empty, scores) # drop duplicates
+    tmp_file = '%s.tmp%d' %(score_file, os.getpid())
+    with open(tmp_file, 'wb') as f:
+        np.savez(f, **scores)
+    os.replace(tmp_file, score_file)
+
+def load_scores(score_file):
+    '''
+    Score dict: 'names' (basenames), 'prob', 'size' and 'mtime_ns'.
+    '''
+    with np.load(score_file) as f:
+        scores = {k: f[k] for k in f.files}
+    for k in ('size', 'mtime_ns'): # files written without the micrograph stats
+        if k not in scores:
+            scores[k] = np.full(len(scores['names']), -1, dtype='int64')
+    return scores
+
+def stat_micrographs(mic_list):
+    '''
+    Size and mtime (ns) of every micrograph, -1 if it does not exist.
+    '''
+    sizes = np.full(len(mic_list), -1, dtype='int64')
+    mtimes = np.full(len(mic_list), -1, dtype='int64')
+    for i, mic in enumerate(mic_list):
+        try:
+            st = os.stat(mic)
+        except OSError:
+            continue
+        sizes[i] = st.st_size
+        mtimes[i] = st.st_mtime_ns
+    return sizes, mtimes
+
+def stale_mask(scores, mic_list, sizes, mtimes):
+    '''
+    True for the micrographs without a score, or whose size or mtime changed
+    since they were scored.
+    '''
+    if scores is None:
+        return np.ones(len(mic_list), dtype=bool)
+    pos = pd.Index(scores['names']).get_indexer(mic_basename(mic_list))
+    found = pos >= 0
+    stale = ~found
+    stale[found] |= scores['size'][pos[found]] != sizes[found]
+    stale[found] |= scores['mtime_ns'][pos[found]] != mtimes[found]
+    stale |= sizes < 0
+    return stale
+
+def score_table(starfile, scores):
+    '''
+    The star file as a DataFrame with the score of every micrograph in an extra
+    column (NaN for micrographs without a score).
+    '''
+    star_df = star2df(starfile, cache=True)
+    pos = pd.Index(scores['names']).get_indexer(mic_basename(star_df['rlnMicrographName']))
+    prob = np.append(scores['prob'], np.nan)[pos] # pos is -1 if not found
+    return star_df.assign(**{SCORE_COLUMN: prob})
+
+def write_micassess_star(starfile, scores, threshold, output):
+    '''
+    Write the micrographs with a score above the threshold to the output star
+    file, and all the scores to <output>_scores.star.
+    '''
+    star_df = score_table(starfile, scores)
+    df2star(star_df, os.path.splitext(output)[0] + '_scores.star', atomic=True)
+    good_df = star_df[star_df[SCORE_COLUMN] > threshold].drop(columns=[SCORE_COLUMN])
+    df2star(good_df, output, atomic=True)
+    return len(good_df)
+
+def threshold_curve(prob, thresholds):
+    '''
+    Number of good micrographs (score > threshold) for every threshold.
+    '''
+    prob = np.sort(np.asarray(prob).ravel())
+    return len(prob) - np.searchsorted(prob, thresholds, side='right')
+
+def main(**args):
+    wkdir = os.path.abspath(os.path.dirname(args['input'])) # par dir of input file
+    os.chdir(wkdir)
+    scores = load_scores(args['scores'])
+    if args['curve'] is not None:
+        start, stop, step = [float(x) for x in args['curve'].split(',')]
+        thresholds = np.arange(start, stop + step/2, step)
+        counts = threshold_curve(scores['prob'], thresholds)
+        print('threshold  good  fraction')
+        for t, n in zip(thresholds, counts):
+            print('%.3f  %d  %.3f' %(t, n, n/max(len(scores['prob']), 1)))
+    if args['threshold'] is not None:
+        num_good = write_micassess_star(os.path.basename(args['input']), scores, args['threshold'], args['output'])
+        print('%d good micrographs at threshold %s written to %s.' %(num_good, args['threshold'], args['output']))
+
+if __name__ == '__main__':
+    args = setupParserOptions()
+    main(**args)
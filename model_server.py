@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+'''
+Local model server for MicAssess and 2DAssess.
+Loads each .h5 model once and keeps it in memory, then answers batched predict
+requests on a Unix socket, so the assessors do not import Keras and load the
+model on every invocation. micassess.py and 2dassess_pipeline.py use the server
+automatically when it is running on the same socket.
+
+Protocol: every message is a 4-byte big-endian header length, a JSON header,
+and the raw bytes of a numpy array described in the header (dtype and shape).
+
+To use: python model_server.py --preload micassess:/path/to/micassess_051419.h5 &
+'''
+
+import os
+import json
+import struct
+import socket
+import argparse
+import socketserver
+import threading
+import numpy as np
+
+def default_socket():
+    return os.environ.get('CRYOASSESS_SOCKET', '/tmp/cryoassess_%d.sock' %os.getuid())
+
+def setupParserOptions():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-s', '--socket', default=default_socket(),
+                    help="Path of the Unix socket. Default is $CRYOASSESS_SOCKET or /tmp/cryoassess_<uid>.sock.")
+    ap.add_argument('--preload', action='append', default=[],
+                    help="Model to load at startup, as kind:path with kind micassess or 2dassess. Can be given several times.")
+    args = vars(ap.parse_args())
+    return args
+
+def _recv_exact(f, n):
+    data = f.read(n)
+    if len(data) != n:
+        raise ConnectionError('Connection closed.')
+    return data
+
+def send_message(f, header, array=None):
+    if array is not None:
+        array = np.ascontiguousarray(array)
+        header = dict(header, dtype=array.dtype.str, shape=list(array.shape))
+    h = json.dumps(header).encode('utf-8')
+    f.write(struct.pack('>I', len(h)) + h)
+    if array is not None:
+        f.write(array.tobytes())
+    f.flush()
+
+def recv_message(f):
+    n = struct.unpack('>I', _recv_exact(f, 4))[0]
+    header = json.loads(_recv_exact(f, n).decode('utf-8'))
+    if 'shape' not in header:
+        return header, None
+    dtype = np.dtype(header['dtype'])
+    size = int(np.prod(header['shape'])) * dtype.itemsize
+    array = np.frombuffer(_recv_exact(f, size), dtype=dtype).reshape(header['shape'])
+    return header, array
+
+class ModelHandler(socketserver.StreamRequestHandler):
+    '''
+    One connection can send several requests. A request without data is a
+    ping, used by the clients to check that the server is up.
+    '''
+    def handle(self):
+        while True:
+            try:
+                header, batch = recv_message(self.rfile)
+            except ConnectionError:
+                return
+            if batch is None:
+                send_message(self.wfile, {'ok': True})
+                continue
+            try:
+                prob = self.server.predict(header['kind'], header['model'], batch, header.get('batch_size', 32))
+                send_message(self.wfile, {'ok': True}, np.asarray(prob, dtype='float32'))
+            except Exception as e:
+                send_message(self.wfile, {'ok': False, 'error': repr(e)})
+
+class ModelServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''
+    One thread per client connection. The models are used under a lock, one
+    request at a time, in the graph they were loaded in.
+    '''
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        self.models = {}
+        self.lock = threading.Lock()
+        socketserver.UnixStreamServer.__init__(self, socket_path, ModelHandler)
+        os.chmod(socket_path, 0o600)
+
+    def get_model(self, kind, model_file):
+        '''
+        (model, graph) for the model file, loaded on first use. Call under the lock.
+        '''
+        from assess_models import load_assess_model
+        key = (kind, os.path.abspath(model_file))
+        if key not in self.models:
+            print('Loading %s model %s....' %key)
+            model = load_assess_model(*key)
+            graph = None
+            if hasattr(model, '_make_predict_function'):
+                # the TF1 graph is per thread, keep the one the model was built in
+                from keras import backend as K
+                model._make_predict_function()
+                graph = K.get_session().graph
+            self.models[key] = (model, graph)
+        return self.models[key]
+
+    def predict(self, kind, model_file, batch, batch_size):
+        with self.lock:
+            model, graph = self.get_model(kind, model_file)
+            if graph is None:
+                return model.predict(batch, batch_size=batch_size)
+            with graph.as_default():
+                return model.predict(batch, batch_size=batch_size)
+
+def remote_predictor(kind, model_file, socket_path=None, batch_size=32):
+    '''
+    Predictor that sends the batches to the model server, or None if the
+    server is not running.
+    '''
+    socket_path = socket_path or default_socket()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        f = sock.makefile('rwb')
+        send_message(f, {'ping': True})
+        recv_message(f)
+    except (OSError, ConnectionError, ValueError):
+        sock.close()
+        return None
+    model_file = os.path.abspath(model_file)
+
+    def predict(batch, batch_size=batch_size):
+        send_message(f, {'kind': kind, 'model': model_file, 'batch_size': batch_size}, batch)
+        header, prob = recv_message(f)
+        if not header['ok']:
+            raise RuntimeError('Model server error: %s' %header['error'])
+        return prob
+    return predict
+
+def main(**args):
+    if remote_predictor('micassess', '', socket_path=args['socket']) is not None:
+        print('A model server is already listening on %s.' %args['socket'])
+        return
+    try:
+        os.remove(args['socket']) # stale socket of a server that was killed
+    except OSError:
+        pass
+    server = ModelServer(args['socket'])
+    for p in args['preload']:
+        kind, model_file = p.split(':', 1)
+        with server.lock:
+            server.get_model(kind, model_file)
+    print('Model server listening on %s.' %args['socket'])
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(args['socket'])
+
+if __name__ == '__main__':
+    args = setupParserOptions()
+    main(**args)
@@ -2,9 +2,10 @@
 '''
 Read the .mrc files, convert (and scale down with FFT) them to smaller .jpg files,
 and save the .jpg files to a "data" folder under the input directory.
+mrc2arrays does the same conversion in memory, for MicAssess without jpg files,
+and mrc2batches streams the converted micrographs to a queue in batches.
 '''
 
-import mrcfile
 import os
 import glob
 import numpy as np
@@ -14,75 +15,111 @@ from PIL import ImageOps
 import shutil
 import multiprocessing as mp
 import datetime
-import pandas as pd
 import sys
+from star_io import star2miclist
+from mrc_io import read_mrc
+from fft_downsample import downsample
+from functools import partial
 
 def setupParserOptions():
     ap = argparse.ArgumentParser()
     ap.add_argument('-i', '--input',
                     help="Provide the path to the micrographs.star file.")
+    ap.add_argument('--float32', action='store_true',
+                    help="Do the Fourier downsampling in single precision (half the memory).")
+    ap.add_argument('--fft_workers', type=int, default=1,
+                    help="Number of threads of each FFT. The number of conversion processes is the CPU count divided by this. Default is 1.")
     args = vars(ap.parse_args())
     return args
 
-def star2miclist(starfile):
-    with open(starfile) as f:
-        star = f.readlines()
-
-    for i in range(len(star)):
-        if 'loop_' in star[i]:
-            start_idx = i
-            break
-    key_idx = []
-    for j in range(start_idx+1, len(star)):
-        if star[j].startswith('_'):
-            key_idx.append(j)
-
-    keys = [star[ii] for ii in key_idx]
-    star_df = star[1+key_idx[-1]:]
-    star_df = [x.split() for x in star_df]
-    star_df = pd.DataFrame(star_df)
-    star_df = star_df.dropna()
-    star_df.columns = keys
-    mic_list = star_df['_rlnMicrographName\n'].tolist()
-
-    return mic_list
-
-def downsample(x, height=494):
-    """ Downsample 2d array using fourier transform """
-    m,n = x.shape[-2:]
-    # factor = width/n
-    factor = m/height
-    width = round(n/factor/2)*2
-    F = np.fft.rfft2(x)
-    A = F[...,0:height//2,0:width//2+1]
-    B = F[...,-height//2:,0:width//2+1]
-    F = np.concatenate([A,B], axis=0)
-    # S = round(2*factor)
-    # A = F[...,0:m//S,0:n//S+2]
-    # B = F[...,-m//S+1:,0:n//S+2]
-    # F = np.concatenate([A,B], axis=-2)
-    f = np.fft.irfft2(F, s=(height, width))
-    return f
-
-def scale_image(img, height=494):
-    new_img = downsample(img, height)
+def scale_image(img, height=494, float32=False, fft_workers=1):
+    new_img = downsample(img, height, float32=float32, workers=fft_workers)
     new_img = ((new_img-new_img.min())/((new_img.max()-new_img.min())+1e-7)*255).astype('uint8')
     new_img = Image.fromarray(new_img)
     new_img = new_img.convert("L")
     return new_img
 
-def save_image(mrc_name, height=494):
+def save_image(mrc_name, height=494, float32=False, fft_workers=1):
     try:
-        micrograph = mrcfile.open(mrc_name, permissive=True).data
-        new_img = scale_image(micrograph, height)
+        micrograph = read_mrc(mrc_name)
+        new_img = scale_image(micrograph, height, float32, fft_workers)
         new_img.save(os.path.join('MicAssess', 'data', (os.path.basename(mrc_name)[:-4]+'.jpg')))
     except ValueError:
         print('Warning - Having trouble converting this file:', mrc_name)
         pass
 
+def mrc2array(mrc_name, height=494, float32=False, fft_workers=1, size=(494, 494)):
+    '''
+    Downsampled micrograph as the uint8 array MicAssess is fed, i.e. the jpg
+    content resized to size like Keras flow_from_directory does (nearest).
+    Returns None if the file cannot be converted.
+    '''
+    try:
+        micrograph = read_mrc(mrc_name)
+        new_img = scale_image(micrograph, height, float32, fft_workers)
+        return np.asarray(new_img.resize(size, Image.NEAREST))
+    except ValueError:
+        print('Warning - Having trouble converting this file:', mrc_name)
+        return None
+
+def mrc2arrays(mic_list, pool=None, **args):
+    '''
+    Convert all micrographs in memory, with pool if given (see
+    conversion_pool), else with a new pool.
+    Returns the names of the converted micrographs and an (N, 494, 494) uint8 stack.
+    '''
+    fft_workers = args.get('fft_workers', 1)
+    convert = partial(mrc2array, float32=args.get('float32', False), fft_workers=fft_workers)
+    if pool is None:
+        print('CPU count is ', mp.cpu_count())
+        with conversion_pool(**args) as new_pool:
+            arrays = new_pool.map(convert, mic_list)
+    else:
+        arrays = pool.map(convert, mic_list)
+    names = [name for name, a in zip(mic_list, arrays) if a is not None]
+    arrays = [a for a in arrays if a is not None]
+    stack = np.stack(arrays) if arrays else np.empty((0, 494, 494), dtype='uint8')
+    print('Conversion finished.')
+    return names, stack
+
+def conversion_pool(**args):
+    '''
+    Pool of conversion workers, one per fft_workers CPUs. Create it before
+    Keras/TF is loaded (or imported) in the process, so no worker is forked
+    from a multi-threaded process.
+    '''
+    return mp.Pool(max(1, mp.cpu_count()//args.get('fft_workers', 1)))
+
+def mrc2batches(mic_list, batch_queue, batch_size, pool, **args):
+    '''
+    Producer for the streaming mode of MicAssess: convert the micrographs with
+    pool (see conversion_pool) and put (names, uint8 stack) batches, in the
+    order of mic_list, on batch_queue. The queue should be bounded so
+    conversion cannot run far ahead of the model. If the conversion fails, the
+    exception is put on the queue, for the consumer to raise. None is put on
+    the queue at the end, even after an error.
+    '''
+    convert = partial(mrc2array, float32=args.get('float32', False), fft_workers=args.get('fft_workers', 1))
+    try:
+        names, arrays = [], []
+        for name, a in zip(mic_list, pool.imap(convert, mic_list)):
+            if a is None:
+                continue
+            names.append(name)
+            arrays.append(a)
+            if len(arrays) == batch_size:
+                batch_queue.put((names, np.stack(arrays)))
+                names, arrays = [], []
+        if arrays:
+            batch_queue.put((names, np.stack(arrays)))
+    except Exception as e:
+        batch_queue.put(e)
+    finally:
+        batch_queue.put(None)
+
 def mrc2jpg(**args):
     os.chdir(os.path.abspath(os.path.dirname(args['input']))) # navigate to the par dir of input file
-    mic_list = star2miclist(os.path.basename(args['input']))
+    mic_list = star2miclist(os.path.basename(args['input']), cache=True)
     try:
         shutil.rmtree('MicAssess')
     except OSError:
@@ -90,9 +127,11 @@ def mrc2jpg(**args):
     os.mkdir('MicAssess')
     os.mkdir(os.path.join('MicAssess', 'data'))
 
-    pool = mp.Pool(mp.cpu_count())
+    fft_workers = args.get('fft_workers', 1)
+    convert = partial(save_image, float32=args.get('float32', False), fft_workers=fft_workers)
+    pool = mp.Pool(max(1, mp.cpu_count()//fft_workers))
     print('CPU count is ', mp.cpu_count())
-    pool.map(save_image, [mrc_name for mrc_name in mic_list])
+    pool.map(convert, [mrc_name for mrc_name in mic_list])
     pool.close()
     print('Conversion finished.')
 
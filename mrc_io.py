@@ -0,0 +1,29 @@
+'''
+Header-only and memory-mapped access to mrc files.
+Dimensions come from the header alone, and data is read through a memory map.
+Every function closes the file before returning, so long runs do not leak file
+descriptors.
+'''
+
+import mrcfile
+import numpy as np
+
+def mrc_shape(mrc_name):
+    '''
+    Shape of the data from the header only: (height, width) for an image,
+    (nz, height, width) for a stack or a volume.
+    '''
+    with mrcfile.open(mrc_name, header_only=True, permissive=True) as mrc:
+        nx, ny, nz = int(mrc.header.nx), int(mrc.header.ny), int(mrc.header.nz)
+    if nz == 1:
+        return ny, nx
+    return nz, ny, nx
+
+def read_mrc(mrc_name, dtype=None):
+    '''
+    Read the data of an mrc file into memory through a memory map.
+    '''
+    with mrcfile.mmap(mrc_name, permissive=True) as mrc:
+        if mrc.data is None:
+            raise ValueError('No data could be read from %s.' %mrc_name)
+        return np.array(mrc.data, dtype=dtype)
@@ -1,12 +1,23 @@
 #!/usr/bin/env python3
 import os
 import argparse
-import mrcfile
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+from mrc_io import mrc_shape
+from star_io import star2df, df2star
+from star_select import mic_basename
 import glob
 
 '''
-Input a directory of micrographs in mrc format (must all be the same size).
-Output a file named "mrc_size.txt" with the first line is height, second line is width.
+Input a directory of micrographs in mrc format.
+Output a file named "mrc_size.txt" with the first line is height, second line is width
+(of the first micrograph).
+Also builds an index of the size of every micrograph, mrc_sizes.star
+(rlnMicrographName, rlnImageSizeX, rlnImageSizeY), from the mrc headers only,
+read in parallel. The index is kept in the parent directory of the input, and
+only the micrographs that are not in it yet are read on later runs. Later
+stages look up the size of a micrograph by name with load_size_index.
 '''
 
 
@@ -14,21 +25,71 @@ def setupParserOptions():
     ap = argparse.ArgumentParser()
     ap.add_argument('-i', '--input',
                     help="Input directory of the micrographs in mrc format.")
+    ap.add_argument('--index', default='mrc_sizes.star',
+                    help="Name of the size index of all the micrographs. Default is mrc_sizes.star.")
+    ap.add_argument('-j', '--processes', type=int, default=mp.cpu_count(),
+                    help="Number of headers read in parallel. Default is the number of CPUs.")
     args = vars(ap.parse_args())
     return args
 
+def _image_size(mrc_name):
+    try:
+        shape = mrc_shape(mrc_name)
+    except (OSError, ValueError):
+        print('Warning - Cannot read the header of', mrc_name)
+        return -1, -1
+    return shape[-1], shape[-2] # x (width), y (height)
+
+def build_size_index(mrc_list, index_file, processes=1):
+    '''
+    Size table of the micrographs, reusing the rows of the existing index file
+    and reading only the headers of the new micrographs. The index file is
+    rewritten if there are new micrographs.
+    '''
+    old = None
+    if os.path.isfile(index_file):
+        old = star2df(index_file)
+        new_list = [m for m, k in zip(mrc_list, mic_basename(mrc_list).isin(mic_basename(old['rlnMicrographName']))) if not k]
+    else:
+        new_list = list(mrc_list)
+    if not new_list:
+        return old
+    with mp.Pool(max(1, min(processes, len(new_list)))) as pool:
+        sizes = np.array(pool.map(_image_size, new_list, chunksize=max(1, len(new_list)//(4*processes))),
+                         dtype='int64').reshape(-1, 2)
+    new = pd.DataFrame({'rlnMicrographName': new_list,
+                        'rlnImageSizeX': sizes[:, 0],
+                        'rlnImageSizeY': sizes[:, 1]})
+    new = new[new['rlnImageSizeX'] >= 0]
+    index = new if old is None else pd.concat([old, new], ignore_index=True)
+    df2star(index, index_file, atomic=True)
+    return index
+
+def load_size_index(index_file):
+    '''
+    {micrograph basename: (height, width)} from a size index file.
+    '''
+    index = star2df(index_file, cache=True)
+    names = mic_basename(index['rlnMicrographName'])
+    return dict(zip(names, zip(index['rlnImageSizeY'].tolist(), index['rlnImageSizeX'].tolist())))
 
 def mrc_size(**args):
     wkdir = os.path.abspath(os.path.join(args['input'], os.pardir))
     os.chdir(wkdir)
-    mrc_f = os.listdir(args['input'])[0]
-    height, width = mrcfile.open(os.path.join(args['input'], mrc_f)).data.shape
+    mrc_list = sorted(glob.glob(os.path.join(args['input'], '*.mrc')))
+    index = build_size_index(mrc_list, args['index'], args['processes'])
+    if index is None or len(index) == 0:
+        raise ValueError('No readable mrc file in %s.' %args['input'])
+    width, height = int(index['rlnImageSizeX'].iloc[0]), int(index['rlnImageSizeY'].iloc[0])
 
     output = 'mrc_size.txt'
     with open(output, 'w') as f:
         f.write('%d\n'%height)
         f.write('%d\n'%width)
 
+    sizes = index[['rlnImageSizeY', 'rlnImageSizeX']].drop_duplicates()
+    if len(sizes) > 1:
+        print('Micrographs of %d different sizes, see %s.' %(len(sizes), args['index']))
     return height, width
 
 
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+import os
+import argparse
+import multiprocessing as mp
+from functools import partial
+import numpy as np
+from scipy.spatial import cKDTree
+from rm_edge_coord import split_coord_star, coord_columns, rewrite_coord_file, process_coord_files
+
+'''
+Loop every coord star files, remove the duplicate and overlapping particles.
+Non-maximum suppression per micrograph: the picks are visited from the highest
+crYOLO confidence (rlnAutopickFigureOfMerit) down, or in file order if the file
+has no confidence, and every kept pick removes the other picks closer than
+fraction * boxsize (found with a KD-tree). The files are processed by a worker
+pool, and written back in place, or to <output>/micrographs/ with -o, with
+the same report as rm_edge_coord.py (rm_dup_report.star).
+
+e.g.: rm_dup_coord.py -i ./ppicker/ -b 142 --apix 1 --fraction 0.5
+'''
+
+def setupParserOptions():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-i', '--input',
+                    help="Path to the ppicker directory")
+    ap.add_argument('-o', '--output', default=None,
+                    help="Directory to write the filtered coordinate files to (in <output>/micrographs/, like the input). Default is to overwrite the input files.")
+    ap.add_argument('-b', '--boxsize',
+                    help="Boxsize of particle picking (not for later extraction!) in Angstrom")
+    ap.add_argument('--apix',
+                    help="Pixel size of the original mrc images (e.g. 0.66 A/pixel)")
+    ap.add_argument('--fraction', type=float, default=0.5,
+                    help="Picks closer than this fraction of the boxsize are duplicates. Default is 0.5.")
+    ap.add_argument('-j', '--processes', type=int, default=mp.cpu_count(),
+                    help="Number of coordinate files processed in parallel. Default is the number of CPUs.")
+    ap.add_argument('--report', default='rm_dup_report.star',
+                    help="Name of the report of the kept and removed particles of every micrograph. Default is rm_dup_report.star.")
+    args = vars(ap.parse_args())
+    return args
+
+def nms_mask(xy, radius, score=None):
+    '''
+    True for the picks kept by non-maximum suppression within radius, visiting
+    the picks by decreasing score (stable, so ties keep the file order).
+    '''
+    keep = np.zeros(len(xy), dtype=bool)
+    valid = np.flatnonzero(~np.isnan(xy).any(axis=1))
+    if len(valid) == 0:
+        return keep
+    if score is not None and not np.isnan(score[valid]).any():
+        valid = valid[np.argsort(-score[valid], kind='stable')]
+    neighbours = cKDTree(xy[valid]).query_ball_point(xy[valid], radius)
+    suppressed = np.zeros(len(valid), dtype=bool)
+    for n in range(len(valid)):
+        if suppressed[n]:
+            continue
+        keep[valid[n]] = True
+        suppressed[neighbours[n]] = True
+    return keep
+
+def rm_dup_file(coord_file, radius, output_dir=None):
+    '''
+    Remove the duplicate picks of one coordinate file, in place or to output_dir.
+    Returns (micrograph name, number kept, number removed).
+    '''
+    with open(coord_file) as f:
+        lines = f.readlines()
+    header, labels, body = split_coord_star(lines)
+    values = coord_columns(labels, body, ('rlnCoordinateX', 'rlnCoordinateY', 'rlnAutopickFigureOfMerit'))
+    score = values[:, 2] if 'rlnAutopickFigureOfMerit' in labels else None
+    keep = nms_mask(values[:, :2], radius, score)
+    out_file = None if output_dir is None else os.path.join(output_dir, os.path.basename(coord_file))
+    return rewrite_coord_file(coord_file, header, body, keep, ~np.isnan(values[:, 0]), out_file)
+
+def rm_dup(**args):
+
+    args['input'] = os.path.abspath(args['input'])
+    output_dir = None
+    if args['output'] is not None:
+        output_dir = os.path.join(os.path.abspath(args['output']), 'micrographs')
+        os.makedirs(output_dir, exist_ok=True)
+    wkdir = os.path.abspath(os.path.join(args['input'], os.pardir))
+    os.chdir(wkdir)
+
+    boxsize = int(args['boxsize'])
+    apix = float(args['apix'])
+
+    remove = partial(rm_dup_file, radius=args['fraction']*boxsize/apix, output_dir=output_dir)
+    report = process_coord_files(args['input'], remove, args['processes'], args['report'])
+    print('Removed duplicate particle coordinates.')
+    print('%d micrographs: %d particles kept, %d removed (see %s).'
+          %(len(report), report['NumberKept'].sum(), report['NumberRemoved'].sum(), args['report']))
+
+if __name__ == '__main__':
+    args = setupParserOptions()
+    rm_dup(**args)
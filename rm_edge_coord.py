@@ -1,15 +1,28 @@
 #!/usr/bin/env python3
 import os
 import argparse
+import multiprocessing as mp
+from functools import partial
+import numpy as np
 import pandas as pd
 import glob
+from star_io import df2star
+from mrc_size import load_size_index
 
 '''
 Loop every coord star files, remove the edge particles.
 Edge particle is determined based on the extraction boxsize (2*particle boxsize).
 Will not submitted to the cluster. Maybe will later.
+The header of every coordinate file is found by its labels (not a fixed number
+of lines), the edge test is one numpy mask per file, and the files are processed
+by a worker pool. Header and kept rows are written back verbatim, atomically.
+The number of kept and removed particles of every micrograph is written to
+rm_edge_report.star in the parent directory of the input.
+With --size_index (mrc_sizes.star written by mrc_size.py), every micrograph uses
+its own height and width, and --height/--width are only the fallback for the
+micrographs that are not in the index.
 
-e.g.: rm_edge_particles.py -i ./ppicker/ --height 3710 --width 3838 -b 142 --apix 1
+e.g.: rm_edge_coord.py -i ./ppicker/ --height 3710 --width 3838 -b 142 --apix 1
 '''
 
 def setupParserOptions():
@@ -24,45 +37,131 @@ def setupParserOptions():
                     help="Height of the original mrc images in pixel")
     ap.add_argument('--width',
                     help="Width of the original mrc images in pixel")
+    ap.add_argument('--size_index', default=None,
+                    help="Size index of the micrographs written by mrc_size.py (e.g. mrc_sizes.star). If given, the size of every micrograph is looked up in it.")
+    ap.add_argument('-j', '--processes', type=int, default=mp.cpu_count(),
+                    help="Number of coordinate files processed in parallel. Default is the number of CPUs.")
+    ap.add_argument('--report', default='rm_edge_report.star',
+                    help="Name of the report of the kept and removed particles of every micrograph. Default is rm_edge_report.star.")
     args = vars(ap.parse_args())
     return args
 
+def split_coord_star(lines):
+    '''
+    Split the lines of a coordinate star file into the header lines, the
+    labels of the loop (without '_' and '#N'), and the data lines.
+    '''
+    labels = []
+    for i, line in enumerate(lines):
+        s = line.strip()
+        if not s or s.startswith('#') or s.startswith('data_') or s.startswith('loop_'):
+            continue
+        if s.startswith('_'):
+            labels.append(s.split()[0].lstrip('_'))
+            continue
+        return lines[:i], labels, lines[i:]
+    return lines, labels, []
 
-def rm_edge(**args):
+COORD_COLUMN_DEFAULTS = {'rlnCoordinateX': 0, 'rlnCoordinateY': 1}
 
-    wkdir = os.path.abspath(os.path.join(args['input'], os.pardir))
-    os.chdir(wkdir)
+def coord_columns(labels, body, columns=('rlnCoordinateX', 'rlnCoordinateY')):
+    '''
+    (len(body), len(columns)) float array of the columns of the data lines.
+    NaN for lines that are not rows, and for columns that are not in the file
+    (X and Y default to the first two columns).
+    '''
+    idx = [labels.index(c) if c in labels else COORD_COLUMN_DEFAULTS.get(c) for c in columns]
+    values = np.full((len(body), len(columns)), np.nan)
+    rows = [n for n, line in enumerate(body) if line.strip()] # blank lines stay NaN
+    tokens = ' '.join(body[n] for n in rows).split()
+    if labels and len(tokens) == len(rows) * len(labels):
+        table = np.array(tokens).reshape(len(rows), len(labels))
+        for j, i in enumerate(idx):
+            if i is not None:
+                values[rows, j] = table[:, i].astype(float)
+        return values
+    # ragged lines: only the complete rows have values
+    need = max(i for i in idx if i is not None) + 1
+    for n, line in enumerate(body):
+        row = line.split()
+        if len(row) >= need and (not labels or len(row) >= len(labels)):
+            values[n] = [np.nan if i is None else float(row[i]) for i in idx]
+    return values
 
-    boxsize = int(args['boxsize'])
-    width = int(args['width'])
-    height = int(args['height'])
-    apix = float(args['apix'])
+def rewrite_coord_file(coord_file, header, body, keep, is_row, out_file=None):
+    '''
+    Write the header and the kept data lines of a coordinate file, atomically,
+    in place or to out_file. is_row marks the data lines that are rows.
+    Returns (micrograph name, number kept, number removed).
+    '''
+    out_file = coord_file if out_file is None else out_file
+    tmp_file = '%s.tmp%d' %(out_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        f.writelines(header)
+        f.writelines(line for line, k in zip(body, keep) if k)
+    os.replace(tmp_file, out_file)
+    name = os.path.splitext(os.path.basename(coord_file))[0]
+    return name, int(keep.sum()), int((is_row & ~keep).sum())
 
-    for p in glob.glob(os.path.join(args['input'], micrographs, '*')):
+def process_coord_files(input_dir, func, processes, report_file):
+    '''
+    Run func on every <input_dir>/micrographs/*.star file with a worker pool,
+    and write the (micrograph name, number kept, number removed) it returns
+    for each file to report_file. Returns the report.
+    '''
+    coord_files = sorted(glob.glob(os.path.join(input_dir, 'micrographs', '*.star')))
+    with mp.Pool(max(1, min(processes, len(coord_files)))) as pool:
+        report = pool.map(func, coord_files, chunksize=max(1, len(coord_files)//(4*processes)))
+    report = pd.DataFrame(report, columns=['rlnMicrographName', 'NumberKept', 'NumberRemoved'])
+    df2star(report, report_file, atomic=True)
+    return report
 
-        with open(p) as f:
-            coord = f.readlines()
+def edge_mask(xy, margin, width, height):
+    '''
+    True for the particles at least margin pixels away from the edges.
+    '''
+    x, y = xy[:, 0], xy[:, 1]
+    return (x > margin) & (x < width - margin) & (y > margin) & (y < height - margin)
 
-        header = coord[0:9]
-        coord = coord[9:]
-        coord_df = [x.split() for x in coord]
-        coord_df = pd.DataFrame(coord_df, dtype=float)
-        coord_df = coord_df.dropna()
+def rm_edge_file(coord_file, margin, width, height, sizes=None):
+    '''
+    Remove the edge particles of one coordinate file, in place.
+    sizes: {micrograph name: (height, width)}, width and height are used for the
+    micrographs that are not in it.
+    Returns (micrograph name, number kept, number removed).
+    '''
+    name = os.path.splitext(os.path.basename(coord_file))[0]
+    if sizes is not None and name in sizes:
+        height, width = sizes[name]
+    if width is None or height is None:
+        print('Warning - Unknown size of micrograph %s, coordinates kept.' %name)
+        return name, -1, -1
+    with open(coord_file) as f:
+        lines = f.readlines()
+    header, labels, body = split_coord_star(lines)
+    xy = coord_columns(labels, body)
+    keep = edge_mask(xy, margin, width, height)
+    return rewrite_coord_file(coord_file, header, body, keep, ~np.isnan(xy[:, 0]))
 
-        good_list = []
-        for i in range(len(coord_df)):
-            particle = coord_df.iloc[i,:].values
-            if particle[0] > (boxsize/apix) and particle[0] < width-(boxsize/apix):
-                if particle[1] > (boxsize/apix) and particle[1] < height-(boxsize/apix):
-                    good_list.append(coord[i])
+def rm_edge(**args):
 
-        with open(p, 'w') as f:
-            for l_0 in header:
-                f.write(l_0)
-            for l_1 in good_list:
-                f.write(l_1)
+    args['input'] = os.path.abspath(args['input'])
+    sizes = None
+    if args['size_index'] is not None:
+        sizes = load_size_index(os.path.abspath(args['size_index']))
+    wkdir = os.path.abspath(os.path.join(args['input'], os.pardir))
+    os.chdir(wkdir)
+
+    boxsize = int(args['boxsize'])
+    width = None if args['width'] is None else int(args['width'])
+    height = None if args['height'] is None else int(args['height'])
+    apix = float(args['apix'])
 
+    remove = partial(rm_edge_file, margin=boxsize/apix, width=width, height=height, sizes=sizes)
+    report = process_coord_files(args['input'], remove, args['processes'], args['report'])
     print('Removed particle coordinates that will clip the micrograph edges.')
+    print('%d micrographs: %d particles kept, %d removed (see %s).'
+          %(len(report), report['NumberKept'].clip(lower=0).sum(), report['NumberRemoved'].clip(lower=0).sum(), args['report']))
 
 if __name__ == '__main__':
     args = setupParserOptions()
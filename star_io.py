@@ -0,0 +1,389 @@
+'''
+Shared reader for RELION star files.
+The file is streamed once, line by line. Every data block is understood, loop
+columns are parsed in chunks straight into typed numpy arrays (int, float or
+string), and the "#N" suffixes are stripped from the column names, so a column
+is addressed as e.g. star_df['rlnMicrographName'].
+With cache=True the parsed tables are also stored in a sidecar directory next to
+the star file (one .npy file per column), keyed on the path, size and mtime of
+the star file, and memory-mapped on later reads instead of being re-parsed.
+String columns are stored as 1-byte ASCII arrays, or as codes into the unique
+strings when values repeat, so the cache stays smaller than the star file.
+read_star_block seeks straight to one named data block (e.g. data_model_classes
+of a _model.star file) through a byte-offset index of the blocks, and only
+parses that block.
+'''
+
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+
+CHUNK_ROWS = 65536
+
+def _label(s):
+    # '_rlnMicrographName #1' -> 'rlnMicrographName'
+    return s.split()[0].lstrip('_')
+
+def _typed(col):
+    '''
+    Convert an array of tokens to int64, else float64, else keep the strings.
+    '''
+    for dtype in (np.int64, np.float64):
+        try:
+            return col.astype(dtype)
+        except (ValueError, OverflowError):
+            pass
+    return col.astype(object)
+
+def _typed_value(s):
+    return _typed(np.array([s]))[0]
+
+def _parse_rows(lines, ncols, col_idx):
+    '''
+    Parse a chunk of loop rows into one typed array per wanted column.
+    '''
+    tokens = ' '.join(lines).split()
+    if len(tokens) == len(lines) * ncols:
+        table = np.array(tokens).reshape(len(lines), ncols)
+    else:
+        # Ragged chunk: drop the incomplete rows like the old dropna() did.
+        rows = [x.split()[:ncols] for x in lines]
+        rows = [x for x in rows if len(x) == ncols]
+        table = np.array(rows, dtype=str).reshape(len(rows), ncols)
+    return [_typed(table[:, j]) for j in col_idx]
+
+def _merge(chunks):
+    if len(chunks) == 0:
+        return np.empty(0, dtype=object)
+    if any(c.dtype == object for c in chunks):
+        chunks = [c.astype(str).astype(object) for c in chunks]
+    return np.concatenate(chunks)
+
+def _wanted(columns):
+    if columns is None:
+        return None
+    return set(c.lstrip('_') for c in columns)
+
+def parse_star_lines(lines, columns=None, blocks=None):
+    '''
+    Parse an iterable of star file lines in a single pass.
+    Returns a dict {block name: block}, in file order. A loop block is a
+    DataFrame, a block of key-value pairs is a dict.
+    columns: only keep these columns (with or without the leading '_').
+    blocks: only parse these blocks (e.g. ['data_model_classes']).
+    '''
+    wanted = _wanted(columns)
+    out = {}
+    name = None
+    state = None # None, 'keys' or 'rows'
+    keys, col_idx, chunk, parsed = [], [], [], []
+
+    def close_loop():
+        if state is None or not keys:
+            return
+        if chunk:
+            parsed.append(_parse_rows(chunk, len(keys), col_idx))
+        data = {}
+        for n, j in enumerate(col_idx):
+            data[keys[j]] = _merge([p[n] for p in parsed])
+        out[name] = pd.DataFrame(data, columns=[keys[j] for j in col_idx])
+
+    for line in lines:
+        s = line.strip()
+        if not s or s.startswith('#'):
+            continue
+        if s.startswith('data_'):
+            close_loop()
+            name = s.split()[0]
+            state = None
+            keys, col_idx, chunk, parsed = [], [], [], []
+            if blocks is None or name in blocks:
+                out[name] = {}
+            continue
+        if name not in out:
+            continue # block not requested
+        if s.startswith('loop_'):
+            close_loop()
+            state = 'keys'
+            keys, col_idx, chunk, parsed = [], [], [], []
+            continue
+        if state == 'keys' and s.startswith('_'):
+            keys.append(_label(s))
+            if wanted is None or keys[-1] in wanted:
+                col_idx.append(len(keys)-1)
+            continue
+        if state is None:
+            # key-value pair outside a loop
+            kv = s.split(None, 1)
+            if kv[0].startswith('_') and (wanted is None or _label(kv[0]) in wanted):
+                out[name][_label(kv[0])] = _typed_value(kv[1].strip()) if len(kv) > 1 else ''
+            continue
+        state = 'rows'
+        chunk.append(s)
+        if len(chunk) == CHUNK_ROWS:
+            parsed.append(_parse_rows(chunk, len(keys), col_idx))
+            chunk = []
+    close_loop()
+    return out
+
+def _select(star, columns=None, blocks=None):
+    wanted = _wanted(columns)
+    out = {}
+    for name, block in star.items():
+        if blocks is not None and name not in blocks:
+            continue
+        if wanted is None:
+            out[name] = block
+        elif isinstance(block, pd.DataFrame):
+            out[name] = block[[c for c in block.columns if c in wanted]]
+        else:
+            out[name] = {k: v for k, v in block.items() if k in wanted}
+    return out
+
+def _cache_dir(starfile):
+    return os.path.join(os.path.dirname(os.path.abspath(starfile)),
+                        '.%s.cache' %os.path.basename(starfile))
+
+def _cache_key(starfile):
+    st = os.stat(starfile)
+    return {'source': os.path.abspath(starfile), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+def _json_value(v):
+    return v.item() if isinstance(v, np.generic) else v
+
+CACHE_FORMAT = 2
+
+def _save_strings(path, col):
+    '''
+    Save a string column compactly: ASCII strings as 1-byte (S) arrays, and
+    columns with repeated values (e.g. rlnMicrographName of a particle star) as
+    codes into a table of the unique strings. Returns the storage kind.
+    '''
+    codes, uniques = pd.factorize(col)
+    uniques = np.asarray(uniques).astype(str)
+    try:
+        uniques = np.char.encode(uniques, 'ascii')
+    except UnicodeEncodeError:
+        pass
+    if len(uniques) <= len(col) // 2:
+        np.save(path + '_u.npy', uniques)
+        np.save(path + '.npy', codes.astype(np.min_scalar_type(max(len(uniques)-1, 0))))
+        return 'codes'
+    np.save(path + '.npy', uniques[codes])
+    return 'strings'
+
+def _load_strings(path, kind):
+    # only the unique strings become Python objects, the codes stay memory-mapped
+    if kind == 'codes':
+        uniques = np.load(path + '_u.npy').astype(str).astype(object)
+        return uniques[np.load(path + '.npy', mmap_mode='r')]
+    return np.load(path + '.npy', mmap_mode='r').astype(str).astype(object)
+
+def _write_cache(starfile, star, key):
+    cache_dir = _cache_dir(starfile)
+    tmp_dir = '%s.tmp%d' %(cache_dir, os.getpid())
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.mkdir(tmp_dir)
+    meta = dict(key, format=CACHE_FORMAT, blocks=[])
+    for i, (name, block) in enumerate(star.items()):
+        if isinstance(block, pd.DataFrame):
+            kinds = []
+            for j, c in enumerate(block.columns):
+                col = np.asarray(block[c])
+                path = os.path.join(tmp_dir, '%d_%d' %(i, j))
+                if col.dtype.kind in 'iufb':
+                    np.save(path + '.npy', col)
+                    kinds.append('array')
+                else:
+                    kinds.append(_save_strings(path, col))
+            meta['blocks'].append({'name': name, 'loop': True, 'columns': list(block.columns), 'kinds': kinds})
+        else:
+            meta['blocks'].append({'name': name, 'loop': False,
+                                   'values': {k: _json_value(v) for k, v in block.items()}})
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.rename(tmp_dir, cache_dir)
+
+def _read_cache(starfile, key, columns=None, blocks=None):
+    '''
+    Return the cached blocks, or None if there is no cache or it is stale.
+    Only the requested columns are loaded; numeric columns are memory-mapped.
+    '''
+    cache_dir = _cache_dir(starfile)
+    try:
+        with open(os.path.join(cache_dir, 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('format') != CACHE_FORMAT or any(meta.get(k) != v for k, v in key.items()):
+        return None
+    wanted = _wanted(columns)
+    out = {}
+    for i, b in enumerate(meta['blocks']):
+        if blocks is not None and b['name'] not in blocks:
+            continue
+        if not b['loop']:
+            out[b['name']] = {k: v for k, v in b['values'].items() if wanted is None or k in wanted}
+            continue
+        data = {}
+        for j, (c, kind) in enumerate(zip(b['columns'], b['kinds'])):
+            if wanted is None or c in wanted:
+                path = os.path.join(cache_dir, '%d_%d' %(i, j))
+                if kind == 'array':
+                    data[c] = np.load(path + '.npy', mmap_mode='r')
+                else:
+                    data[c] = _load_strings(path, kind)
+        out[b['name']] = pd.DataFrame(data, columns=list(data), copy=False)
+    return out
+
+def read_star(starfile, columns=None, blocks=None, cache=False):
+    '''
+    Read all (or the requested) data blocks of a star file.
+    See parse_star_lines for the return value.
+    With cache=True, the sidecar cache is used if it is up to date, otherwise
+    the whole file is parsed and the cache is (re)written.
+    '''
+    if not cache:
+        with open(starfile) as f:
+            return parse_star_lines(f, columns=columns, blocks=blocks)
+    key = _cache_key(starfile)
+    star = _read_cache(starfile, key, columns=columns, blocks=blocks)
+    if star is not None:
+        return star
+    with open(starfile) as f:
+        star = parse_star_lines(f)
+    try:
+        _write_cache(starfile, star, key)
+    except OSError:
+        print('Warning - Cannot write the star file cache for', starfile)
+    return _select(star, columns=columns, blocks=blocks)
+
+def star_block_index(starfile, until=None):
+    '''
+    Byte-offset index of the data blocks of a star file: {block name: (start,
+    end)}, in file order. The scan stops at the end of block until if given.
+    '''
+    index = {}
+    name, start, pos = None, 0, 0
+    with open(starfile, 'rb') as f:
+        for line in f:
+            if line.startswith(b'data_'):
+                if name is not None:
+                    index[name] = (start, pos)
+                    if name == until:
+                        return index
+                name, start = line.split()[0].decode('utf-8'), pos
+            pos += len(line)
+    if name is not None:
+        index[name] = (start, pos)
+    return index
+
+def read_star_block(starfile, block, columns=None):
+    '''
+    Read one data block of a star file (a DataFrame with typed columns for a
+    loop block, a dict for key-value pairs) without parsing the other blocks.
+    '''
+    index = star_block_index(starfile, until=block)
+    if block not in index:
+        raise ValueError('No block %s in %s.' %(block, starfile))
+    start, end = index[block]
+    with open(starfile, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).decode('utf-8').splitlines()
+    return parse_star_lines(lines, columns=columns)[block]
+
+def star2df(starfile, columns=None, block=None, cache=False):
+    '''
+    Read one loop block of a star file into a DataFrame with typed columns.
+    If block is not given, the last loop block of the file is used, which is the
+    data table for both Relion 3.0 files and Relion 3.1 files with optics groups.
+    '''
+    star = read_star(starfile, columns=columns,
+                     blocks=None if block is None else [block], cache=cache)
+    loops = [b for b in star.values() if isinstance(b, pd.DataFrame)]
+    if block is not None:
+        if block not in star or not isinstance(star[block], pd.DataFrame):
+            raise ValueError('No loop block %s in %s.' %(block, starfile))
+        return star[block]
+    if not loops:
+        raise ValueError('No loop block in %s.' %starfile)
+    return loops[-1]
+
+def star2miclist(starfile, cache=False):
+    '''
+    List of the micrograph names (rlnMicrographName) in a star file.
+    '''
+    star_df = star2df(starfile, columns=['rlnMicrographName'], cache=cache)
+    return star_df['rlnMicrographName'].tolist()
+
+def _format_column(col):
+    # Floats keep their shortest round-trip repr, as numpy does for astype(str).
+    return np.asarray(col).astype(str).tolist()
+
+def _write_block(f, star_df, block, chunk_rows=CHUNK_ROWS):
+    keys = ['_%s #%d \n' %(k, i+1) for i, k in enumerate(star_df.columns)]
+    f.write(''.join(['%s \n' %block, '\n', 'loop_ \n'] + keys))
+    _write_rows(f, star_df, chunk_rows)
+
+def df2star(star_df, star_name, block='data_', atomic=False, chunk_rows=CHUNK_ROWS):
+    '''
+    Write a DataFrame as a single loop block, with the header layout Relion 3.0
+    writes. Whole columns are formatted at once and written in large chunks.
+    With atomic=True the file is written to a temporary name and renamed when
+    complete, so readers never see a half-written file.
+    '''
+    write_star_blocks({block: star_df}, star_name, atomic=atomic, chunk_rows=chunk_rows)
+
+def write_star_blocks(blocks, star_name, atomic=False, chunk_rows=CHUNK_ROWS):
+    '''
+    Write several DataFrames as loop blocks, given as {block name: DataFrame}
+    (block names like 'data_diam100k200'), in the layout of df2star.
+    '''
+    tmp_name = '%s.tmp%d' %(star_name, os.getpid()) if atomic else star_name
+    with open(tmp_name, 'w', buffering=1<<20) as f:
+        for n, (block, star_df) in enumerate(blocks.items()):
+            if n > 0:
+                f.write('\n')
+            _write_block(f, star_df, block, chunk_rows)
+    if atomic:
+        os.replace(tmp_name, star_name)
+
+def _write_rows(f, star_df, chunk_rows=CHUNK_ROWS):
+    for start in range(0, len(star_df), chunk_rows):
+        chunk = star_df.iloc[start:start+chunk_rows]
+        cols = [_format_column(chunk[c].values) for c in chunk.columns]
+        f.write(' \n'.join('  '.join(row) for row in zip(*cols)) + ' \n')
+
+def _loop_labels(star_name):
+    # labels of the last loop block of a star file
+    labels = []
+    in_header = False
+    with open(star_name) as f:
+        for line in f:
+            s = line.strip()
+            if s.startswith('loop_'):
+                labels, in_header = [], True
+            elif in_header and s.startswith('_'):
+                labels.append(_label(s))
+            elif in_header and s:
+                in_header = False
+    return labels
+
+def append_star_rows(star_df, star_name):
+    '''
+    Append rows to the loop of a star file written by df2star. The columns are
+    put in the order of the file header, and must be the same as the header.
+    The file is created if it does not exist yet.
+    '''
+    if not os.path.isfile(star_name) or os.path.getsize(star_name) == 0:
+        df2star(star_df, star_name, atomic=True)
+        return
+    labels = _loop_labels(star_name)
+    if sorted(labels) != sorted(star_df.columns):
+        raise ValueError('Cannot append columns %s to %s, which has columns %s.'
+                         %(list(star_df.columns), star_name, labels))
+    with open(star_name, 'a', buffering=1<<20) as f:
+        _write_rows(f, star_df[labels])
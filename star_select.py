@@ -0,0 +1,54 @@
+'''
+Select rows of a star table by the values of one column.
+The selection values are put in a hash index once (pandas Index) and the
+selection mask for the whole table is computed in one vectorized pass, so
+filtering stays linear in the number of rows.
+Values can be compared by micrograph basename (key='basename'), e.g. to match
+'micrographs/mic_001.mrc' with 'MicAssess/data/mic_001.jpg', by number
+(class numbers given as strings are compared to an integer column), or as is.
+'''
+
+import numpy as np
+import pandas as pd
+
+def mic_basename(names):
+    '''
+    Vectorized os.path.basename without the extension.
+    '''
+    names = pd.Series(np.asarray(names, dtype=object), dtype=object).astype(str)
+    return names.str.rsplit('/', n=1).str[-1].str.replace(r'\.[^.]*$', '', regex=True)
+
+def _keyed(values, key):
+    if key is None:
+        return pd.Series(np.asarray(values, dtype=object), dtype=object)
+    if key == 'basename':
+        return mic_basename(values)
+    return pd.Series([key(v) for v in values], dtype=object)
+
+def build_index(values, key=None, numeric=False):
+    '''
+    Hash index of the selection values.
+    key: None, 'basename' or a function applied to every value.
+    numeric: convert the values to numbers (e.g. class numbers read as strings).
+    '''
+    keyed = _keyed(values, key)
+    if numeric:
+        keyed = pd.to_numeric(keyed, errors='coerce').dropna()
+    return pd.Index(pd.unique(keyed))
+
+def select_mask(column, values, key=None):
+    '''
+    Boolean mask of the entries of column that are in values (an index from
+    build_index or any list, which is then indexed with the same key).
+    '''
+    keyed = pd.Series(np.asarray(column)) if key is None else _keyed(column, key)
+    if not isinstance(values, pd.Index):
+        values = build_index(values, key=key, numeric=pd.api.types.is_numeric_dtype(keyed))
+    return np.asarray(keyed.isin(values))
+
+def keep_rows(star_df, column, values, key=None):
+    '''
+    Rows of star_df whose column value is in values (an index or any list).
+    '''
+    mask = select_mask(star_df[column], values, key=key)
+    return star_df[mask]
@@ -12,8 +12,8 @@ import re
 
 '''
 Submit 2DAssess job to comet.
-Will loop through all the subdirectories in the 2DClass folder and submit multiple
-corresponding 2DAssess jobs.
+A single 2DAssess command assesses all the subdirectories (diameter sweeps) in the
+2DClass folder, with one model load.
 '''
 
 def setupParserOptions():
@@ -39,8 +39,10 @@ def setupParserOptions():
     ## Cluster submission needed
     ap.add_argument('--template', default='comet_submit_template.sh',
                     help="Name of the submission template. Currently only supports comet_submit_template.sh")
-    ap.add_argument('--cluster', default='comet-gpu',
-                    help='The computer cluster the job will run on. Currently only supports comet-gpu.')
+    ap.add_argument('--cluster', default='comet-gpu', choices=['comet-gpu', 'comet-cpu'],
+                    help='The computer cluster the job will run on. comet-gpu (default) or comet-cpu, which needs --backend onnx.')
+    ap.add_argument('--backend', default='keras', choices=['keras', 'onnx'],
+                    help='keras: run the .h5 model (default). onnx: run an ONNX export of the model on the CPU (see cpu_backend.py), -m is then the .onnx file.')
     ap.add_argument('--jobname', default='2DAssess',
                     help='Jobname on the submission script.')
     ap.add_argument('--user_email',
@@ -50,10 +52,12 @@ def setupParserOptions():
     # ap.add_argument('-n', '--nodes', default='1',
     #                 help='Number of nodes used in the computer cluster.')
     args = vars(ap.parse_args())
+    if args['cluster'] == 'comet-cpu' and args['backend'] != 'onnx':
+        ap.error('--cluster comet-cpu needs --backend onnx (and the .onnx model as -m).')
     return args
 
-def editparameters(s, model, name, starfile, outfile):
-    new_s = s.replace('$$model', model).replace('$$name', name)\
+def editparameters(s, model, mrcs_name, starfile, outfile):
+    new_s = s.replace('$$model', model).replace('$$mrcs_name', mrcs_name)\
             .replace('$$starfile', starfile).replace('$$outfile', outfile)
     return new_s
 
@@ -95,9 +99,6 @@ def submit(**args):
     walltime = args['walltime']
     program = args['program']
     nodes = '1'
-    args['starfile'] = os.path.join(args['input'], dir_list[0], args['starfile'])
-    args['input'] = os.path.join(args['input'], dir_list[0], args['mrcs_name'])
-    args['output'] = os.path.join(args['output'], dir_list[0])
     input = '-i %s ' %args['input']
     output = '-o %s ' %args['output']
     stdout = os.path.join('> %s'%args['output'], 'run_%s.out '%args['program'])
@@ -106,7 +107,9 @@ def submit(**args):
     conda_env = 'conda activate /projects/cosmic2/conda/cryoassess'
     command = 'python /home/yilaili/codes/Automatic-preprocessing-COSMIC2/2dassess_pipeline.py '
     parameters = editparameters(job_config[program]['parameters'], args['model'], \
-                                dir_list[0], args['starfile'], args['outfile'])
+                                args['mrcs_name'], args['starfile'], args['outfile'])
+    if args['backend'] == 'onnx':
+        parameters += '--backend onnx --threads %s ' %cluster_config[cluster]['nt_per_node']
 
     write_submit_comet(codedir, wkdir, submit_name, \
                         jobname, user_email, walltime, nodes, \
@@ -114,15 +117,7 @@ def submit(**args):
                         input, output, stdout, stderr, \
                         module, conda_env, command, parameters, \
                         template_file=args['template'],\
-                        cluster='comet-gpu')
-
-    ## Edit submit file so that multiple 2DAssess will be submitted in the same script
-    with open(submit_name, encoding='utf-8') as f:
-        full_cmd = f.readlines()[-1]
-    with open(submit_name, 'a+', encoding='utf-8') as f:
-        for name in dir_list[1:]:
-            new_full_cmd = full_cmd.replace(dir_list[0], name)
-            f.write(new_full_cmd)
+                        cluster=cluster)
 
     cmd='sbatch ' + submit_name
     job_id = subprocess.check_output(cmd, shell=True)
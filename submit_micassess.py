@@ -33,8 +33,10 @@ def setupParserOptions():
     ## Cluster submission needed
     ap.add_argument('--template', default='comet_submit_template.sh',
                     help="Name of the submission template. Currently only supports comet_submit_template.sh")
-    ap.add_argument('--cluster', default='comet-gpu',
-                    help='The computer cluster the job will run on. Currently only supports comet-gpu.')
+    ap.add_argument('--cluster', default='comet-gpu', choices=['comet-gpu', 'comet-cpu'],
+                    help='The computer cluster the job will run on. comet-gpu (default) or comet-cpu, which needs --backend onnx.')
+    ap.add_argument('--backend', default='keras', choices=['keras', 'onnx'],
+                    help='keras: run the .h5 model (default). onnx: run an ONNX export of the model on the CPU (see cpu_backend.py), -m is then the .onnx file.')
     ap.add_argument('--jobname', default='MicAssess',
                     help='Jobname on the submission script.')
     ap.add_argument('--user_email',
@@ -44,6 +46,8 @@ def setupParserOptions():
     # ap.add_argument('-n', '--nodes', default='1',
     #                 help='Number of nodes used in the computer cluster.')
     args = vars(ap.parse_args())
+    if args['cluster'] == 'comet-cpu' and args['backend'] != 'onnx':
+        ap.error('--cluster comet-cpu needs --backend onnx (and the .onnx model as -m).')
     return args
 
 def editparameters(s, model, threshold):
@@ -85,6 +89,9 @@ def submit(**args):
     conda_env = 'conda activate /projects/cosmic2/conda/cryoassess'
     command = 'micassess '
     parameters = editparameters(job_config[program]['parameters'], args['model'], args['threshold'])
+    if args['backend'] == 'onnx':
+        command = 'python %s ' %os.path.join(codedir, 'micassess.py')
+        parameters += '--backend onnx --threads %s ' %cluster_config[cluster]['nt_per_node']
 
     write_submit_comet(codedir, wkdir, submit_name, \
                         jobname, user_email, walltime, nodes, \
@@ -92,7 +99,7 @@ def submit(**args):
                         input, output, stdout, stderr, \
                         module, conda_env, command, parameters, \
                         template_file=args['template'], \
-                        cluster='comet-gpu')
+                        cluster=cluster)
 
     cmd='sbatch ' + submit_name
     job_id = subprocess.check_output(cmd, shell=True)
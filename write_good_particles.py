@@ -5,11 +5,12 @@ Not working for Relion 3.1 with the new optical group in the star file.
 """
 
 import os
-import pandas as pd
 import pickle
 import argparse
 import shutil
 import re
+from star_io import star2df, df2star
+from star_select import keep_rows
 
 def setupParserOptions():
     ap = argparse.ArgumentParser()
@@ -24,41 +25,6 @@ def setupParserOptions():
     args = vars(ap.parse_args())
     return args
 
-def star2df(starfile):
-    with open(starfile) as f:
-        star = f.readlines()
-
-    for i in range(len(star)):
-        if 'loop_' in star[i]:
-            start_idx = i
-            break
-    key_idx = []
-    for j in range(start_idx+1, len(star)):
-        if star[j].startswith('_'):
-            key_idx.append(j)
-
-    keys = [star[ii] for ii in key_idx]
-    star_df = star[1+key_idx[-1]:]
-    star_df = [x.split() for x in star_df]
-    star_df = pd.DataFrame(star_df)
-    star_df = star_df.dropna()
-    star_df.columns = keys
-
-    return star_df
-
-def df2star(star_df, star_name):
-    header = ['data_ \n', '\n', 'loop_ \n']
-    keys = star_df.columns.tolist()
-
-    with open(star_name, 'w') as f:
-        for l_0 in header:
-            f.write(l_0)
-        for l_1 in keys:
-            f.write(l_1)
-        for i in range(len(star_df)):
-            s = '  '.join(star_df.iloc[i].tolist())
-            f.write(s + ' \n')
-
 def read_goodfrac(good_part_frac):
 # From good_part_frac file, find the best subdirectory by finding the maximum good particle fraction.
     with open(good_part_frac) as f:
@@ -78,13 +44,9 @@ def read_goodfrac(good_part_frac):
 #     return header
 
 def write_good_particles_star(class_data_star, good_class_idx, good_particles_star):
-    bad_particles_idx = []
-    class_data_df = star2df(class_data_star)
-    for i in range(len(class_data_df)):
-        if str(int(class_data_df['_rlnClassNumber #3 \n'][i])) not in good_class_idx:
-            bad_particles_idx.append(i)
-    new_class_data_df = class_data_df.drop(bad_particles_idx)
-    df2star(new_class_data_df, good_particles_star)
+    class_data_df = star2df(class_data_star, cache=True)
+    new_class_data_df = keep_rows(class_data_df, 'rlnClassNumber', good_class_idx)
+    df2star(new_class_data_df, good_particles_star, atomic=True)
         # particle = class_data_df.iloc[i,:].values
         # if str(int(particle[2])) in good_class_idx:
         #     good_particles_list.append(class_data[i])